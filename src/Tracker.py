@@ -1,14 +1,26 @@
 from src.torrent import *
 from src.protocol import *
+import src.framing as framing
+from src.ratelimit import TokenBucket
+import src.transport as transport
+import src.profiling as profiling
 import asyncio
 import json
 import sys
 
 class TrackerServer:                              
     #torrent metadata
-    def __init__(self):
+    def __init__(self, max_connections=MAX_CONNECTIONS, request_rate=PEER_REQUEST_RATE, request_burst=PEER_REQUEST_BURST):
         self.nextTorrentId = 0 
         self.torrent = {}              #the torrent list (dictionary), defined by its unique torrentID
+        self.contentIndex = {}         #whole-file content hash -> torrentID, so identical uploads share one swarm
+
+        # Admission control: bounded concurrent requests and a request token bucket per client IP
+        self.maxConnections = max_connections
+        self.activeConnections = 0
+        self.requestRate = request_rate
+        self.requestBurst = request_burst
+        self.ipBuckets = {}
 
     def handleRequest(self, req) -> dict():
         """
@@ -18,9 +30,9 @@ class TrackerServer:
         response = {OPC: opc}
         
         if opc == OPT_GET_LIST:
-            torrent_list = self.getTorrentDict()
+            torrent_list = self.getTorrentDict(req)
             if torrent_list:
-                response.update({ TORRENT_LIST: self.getTorrentDict() })
+                response.update({ TORRENT_LIST: torrent_list })
                 response.update({ RET: RET_SUCCESS })
             else:
                 response.update({ RET: RET_NO_AVAILABLE_TORRENTS })
@@ -51,7 +63,7 @@ class TrackerServer:
 
         return response
     
-    def getTorrentDict(self) -> list():                   #res opcode=1
+    def getTorrentDict(self, req=None) -> list():                   #res opcode=1
         """
         Returns a list of available torrents stored in the tracker.
         """
@@ -61,8 +73,8 @@ class TrackerServer:
             torrentDict[TID] = torrentObj.tid
             torrentDict[FILE_NAME] = torrentObj.filename
             torrentDict[TOTAL_PIECES] = torrentObj.pieces
-            torrentDict[SEEDER_LIST] = torrentObj.getSeeders()
-            torrentDict[LEECHER_LIST] = torrentObj.getLeechers()
+            torrentDict[FILE_ALIASES] = torrentObj.aliases
+            self.addPeerLists(torrentDict, torrentObj, req)
             response.append(torrentDict)
         return response
     
@@ -75,12 +87,34 @@ class TrackerServer:
         torrentDict[TID] = torrentObj.tid
         torrentDict[FILE_NAME] = torrentObj.filename
         torrentDict[TOTAL_PIECES] = torrentObj.pieces
-        torrentDict[SEEDER_LIST] = torrentObj.getSeeders()
-        torrentDict[LEECHER_LIST] = torrentObj.getLeechers()
+        torrentDict[CONTENT_HASH] = torrentObj.content_hash
+        torrentDict[PIECE_HASHES] = torrentObj.piece_hashes
+        if torrentObj.manifest is not None:
+            torrentDict[MANIFEST] = torrentObj.manifest
+        self.addPeerLists(torrentDict, torrentObj, req)
                
         self.torrent[ req[TID] ].addLeecher(req[PID], req[IP], req[PORT])
         return torrentDict
 
+    def addPeerLists(self, torrentDict: dict, torrentObj: Torrent, req):
+        """
+        Adds the torrent's seeders and leechers to torrentDict. Clients asking for COMPACT lists get
+        packed addresses, at most NUMWANT seeders and NUMWANT leechers picked at random, instead of the
+        per-peer dicts. Sampled peers registered with a host name can't be packed, they are still sent in
+        the per-peer dicts.
+        """
+        if req is None or not req.get(COMPACT):
+            torrentDict[SEEDER_LIST] = torrentObj.getSeeders()
+            torrentDict[LEECHER_LIST] = torrentObj.getLeechers()
+            return
+
+        numwant = req.get(NUMWANT, DEFAULT_NUMWANT)
+        for field, compact4, compact6, peers in ((SEEDER_LIST, COMPACT_SEEDERS, COMPACT_SEEDERS6, torrentObj.seeders),
+                                                 (LEECHER_LIST, COMPACT_LEECHERS, COMPACT_LEECHERS6, torrentObj.leechers)):
+            torrentDict[compact4], torrentDict[compact6], named = peers.sample(numwant)
+            if named:
+                torrentDict[field] = named
+
     def updatePeerStatus(self, req:dict) -> int:
         """
         Adds peer to the torrent's peer seeding list
@@ -113,35 +147,83 @@ class TrackerServer:
         Called everytime updateStopSeed() is used, and deletes torrent from the torrent's list if there exist no seeders for it
         """
         if len(self.torrent[tid].seeders) == 0:
+            contentHash = self.torrent[tid].content_hash
+            if self.contentIndex.get(contentHash) == tid:
+                del self.contentIndex[contentHash]
+            # Torrent ids aren't reused, other torrents and the content index stay keyed by theirs
             self.torrent.pop(tid)
-            self.nextTorrentId -= 1
             print(self.torrent)
 
     def addNewFile(self, req: dict) -> int:
         """
         Creates a torrent from the given filename and pieces and adds it to the torrent list. If the client is already seeding a file, return RET_ALREADY_SEEDING
+        If the same content is already being seeded, the uploader joins that torrent's swarm instead.
         """
         for torrentObj in self.torrent.values():
-            if req[PID] in torrentObj.getSeeders():
-                return RET_ALREADY_SEEDING
+            if torrentObj.hasSeeder(req[PID]):
+                return RET_ALREADY_SEEDING, None
+
+        contentHash = req.get(CONTENT_HASH)
+        torrentObj = self.torrent.get(self.contentIndex.get(contentHash)) if contentHash is not None else None
+        if torrentObj is not None and torrentObj.content_hash == contentHash:
+            torrentObj.addSeeder(req[PID], req[IP], req[PORT])
+            if req[FILE_NAME] not in torrentObj.aliases:
+                torrentObj.aliases.append(req[FILE_NAME])
+            print("[TRACKER] Upload of", req[FILE_NAME], "matches torrent", torrentObj.tid, ", joining its swarm.")
+            return RET_SUCCESS, torrentObj.tid
 
-        newTorrent = Torrent(self.nextTorrentId, req[FILE_NAME], req[TOTAL_PIECES])        #create the torrent object
+        newTorrent = Torrent(self.nextTorrentId, req[FILE_NAME], req[TOTAL_PIECES], contentHash, req.get(PIECE_HASHES), req.get(MANIFEST))        #create the torrent object
         newTorrent.addSeeder(req[PID], req[IP], req[PORT])                      #add peer the seeder into torrent object   
         self.torrent[self.nextTorrentId] = newTorrent    #insert into torrent dictionary
+        if contentHash is not None:
+            self.contentIndex[contentHash] = newTorrent.tid
         self.nextTorrentId+=1
         return RET_SUCCESS, newTorrent.tid
     
+    def admitRequest(self, ip):
+        '''
+            Returns 0 if a new connection from ip may be handled, otherwise the seconds it should wait before retrying.
+        '''
+        if self.activeConnections >= self.maxConnections:
+            return 1.0
+
+        if ip not in self.ipBuckets:
+            if len(self.ipBuckets) >= self.maxConnections * 16:
+                # Forget clients that have been idle long enough to have a full bucket again
+                self.ipBuckets = {addr: bucket for addr, bucket in self.ipBuckets.items() if bucket.timeUntil(bucket.burst) > 0}
+            self.ipBuckets[ip] = TokenBucket(self.requestRate, self.requestBurst)
+        bucket = self.ipBuckets[ip]
+        if not bucket.tryConsume():
+            return bucket.timeUntil()
+        return 0
+
     async def receiveRequest(self, reader, writer):
         '''
             Take in the client request
             It will call handleRequest -> give it a response object {"OPT": __, RET: __, "payload": __ }
             receiveRequest will send this ---^ response object
         '''
+        addr = writer.get_extra_info('peername')
+        retryAfter = self.admitRequest(addr[0] if addr else None)
+        if retryAfter:
+            # Refuse without handling the request, so a flood costs as little as possible. The request is
+            # still read once, closing with unread data would reset the connection and lose the answer.
+            print("[TRACKER] Busy, refusing", addr)
+            try:
+                await asyncio.wait_for(reader.read(READ_SIZE), REJECT_TIMEOUT)
+                writer.write(json.dumps({OPC: OPT_RETRY_LATER, RET: RET_RETRY_LATER, RETRY_AFTER: round(retryAfter, 2)}).encode() + b'\n')
+                await asyncio.wait_for(writer.drain(), REJECT_TIMEOUT)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            writer.close()
+            return
+
+        self.activeConnections += 1
+        span = profiling.Span('tracker', addr)
+        status = 'ok'
         try:
-            data = await reader.read(READ_SIZE)
-        
-            cliRequest = json.loads(data.decode())
-            addr = writer.get_extra_info('peername')
+            cliRequest = await asyncio.wait_for(framing.readMessage(reader, span=span), READ_TIMEOUT)
+            span.opc = cliRequest.get(OPC)
 
             print(f"\n[TRACKER] Debug received {cliRequest!r} from {addr!r}.")
             
@@ -149,20 +231,33 @@ class TrackerServer:
             # cliRequest.update({IP:writer.get_extra_info('peername')[0]})
 
             response = self.handleRequest(cliRequest)
+            span.mark('handle')
             # Send payload response toConnecting to tracker at
             # 
             # 
             # 
             #  client
             payload = json.dumps(response)
+            data = payload.encode() + b'\n'
+            span.mark('encode')
             print("[TRACKER] Debug send payload:", payload)
-            writer.write(payload.encode())
+            writer.write(data)
             
-            await writer.drain()
+            await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+            span.mark('write')
             # print("[TRACKER] Closing the connection for", addr)
-        except:
-            print(sys.exc_info()[0])
-            print("[TRACKER] Peer", writer.get_extra_info('peername'), "has disconnected.")
+        except asyncio.TimeoutError:
+            status = 'timeout'
+            print("[TRACKER] Peer", addr, "timed out.")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            status = 'invalid'
+            print("[TRACKER] Invalid request from", addr, ":", e)
+        except ConnectionError:
+            status = 'disconnected'
+            print("[TRACKER] Peer", addr, "has disconnected.")
+        finally:
+            self.activeConnections -= 1
+            span.finish(status)
 
         writer.close()
 
@@ -197,8 +292,9 @@ async def main():
     if port == None:
         port = 8888
         
+    profiling.install()
     t = TrackerServer()
-    server = await asyncio.start_server(t.receiveRequest, ip, port)
+    server = await transport.startServer(t.receiveRequest, ip, port)
     addr = server.sockets[0].getsockname()
     print(f'[TRACKER] Serving on {addr}')
 
@@ -206,4 +302,5 @@ async def main():
         await server.serve_forever()
 
 if __name__ == "__main__":
+    transport.installEventLoop()
     asyncio.run(main())
\ No newline at end of file
@@ -3,15 +3,31 @@ Provides Client's functionalities and actions. See client_handler which is the m
 """
 from src.protocol import *
 import src.file_handler as fd
+import src.compression as compression
+import src.transport as transport
+import src.peerlist as peerlist
+import src.framing as framing
+import src.profiling as profiling
+from src.ratelimit import RateLimiter
+from src.piece_store import piece_store
+from src.piece_cache import piece_cache
 from socket import *
+from collections import OrderedDict
 import json
 import asyncio
+import base64
+import os
 import sys
 import uuid
+import random
 import hashlib
+import time
 import threading
 class Client:
-    def __init__(self, src_ip, src_port):
+    def __init__(self, src_ip, src_port, upload_rate=None, download_rate=None, peer_upload_rate=None, peer_download_rate=None):
+        """
+        The optional rates limit piece transfers in bytes per second, in total and per peer.
+        """
         self.src_ip = src_ip
         self.src_port = src_port
         self.peer_id = self.createPeerID()
@@ -22,29 +38,71 @@ class Client:
         self.peer_am_seeding = False
         self.peer_am_leeching = False
 
+        # Server answering peer requests, running while seeding and while leeching
+        self.server = None
+
+        # Super-seeding (initial seeder only): each piece goes to one leecher until it is seen elsewhere
+        self.super_seed = False
+        self.super_seeding = False
+        self.peer_have = dict()           # peer id -> PieceBuffer of the pieces that peer reported having
+        self.super_assigned = dict()      # peer id -> (piece index, time) of the piece last handed to it
+        self.super_owner = dict()         # piece index -> peer id it was first handed to
+        self.peer_seen = OrderedDict()    # peer id -> time of its last bitfield, oldest first
+        self.super_holders = []           # piece index -> number of peers in peer_have that have it
+        self.super_unspread = set()       # handed out pieces not yet seen at a peer other than their owner
+        self.super_next = 0               # pieces before this index have all been handed out
+        self.super_seeders = set()        # peer ids of seeders that told us they are super-seeding
+
         # List of seeders & piece buffer associated to the current download 
         self.seeders_list = dict()
         self.piece_buffer = PieceBuffer()
 
+        # File or directory on disk backing the piece buffer, pieces are served straight from it when set.
+        # A directory's files are listed in manifest, see file_handler
+        self.seed_path = None
+        self.manifest = None
+
+        # Content hashes of the current file, pieces are verified against and reused by piece_hashes
+        self.content_hash = None
+        self.piece_hashes = []
+
+        # Codecs offered to seeders
+        self.codecs = compression.availableCodecs()
+        # Bitset of the pieces found not to compress, those are sent with sendfile without trying again
+        self.incompressible = bytearray()
+
+        # Bandwidth limits for piece transfers
+        self.upload_limiter = RateLimiter(upload_rate, peer_upload_rate)
+        self.download_limiter = RateLimiter(download_rate, peer_download_rate)
+
+        # Peer exchange: the set of peer ids last advertised to each connected peer
+        self.pex_known = dict()
+        self.tracker_ip = None
+        self.tracker_port = None
+
 
 ########### CONNECTION HANDLING ###########
 
     async def connectToTracker(self, ip, port):
         """
         Handles connecting to the tracker and returns the reader and writer.
+        Raises ConnectionError if the tracker can't be reached.
         """
         if ip == None and port == None:
             # Use default IP and port
             ip = "127.0.0.1"
             port = "8888"
+
+        self.tracker_ip = ip
+        self.tracker_port = port
     
         try:
-            reader, writer = await asyncio.open_connection(ip, int(port))
+            reader, writer = await transport.openConnection(ip, port)
             return reader, writer
 
-        except ConnectionError:
+        except OSError as e:
             print("Connection Error: unable to connect to tracker.")
-            sys.exit(-1) # different exit number can be used, eg) errno library
+            raise ConnectionError("unable to connect to tracker at " + str(ip) + ":" + str(port)) from e
 
     async def connectToPeer(self, ip, port, requests):
         """
@@ -53,66 +111,105 @@ class Client:
         # NOTE: This has same issue as above note in connectToTracker, although I don't think we can take the "printing" out of this one. We can leave these prints.
         try:
             print("Connecting to seeder at " + ip + ":" + port + " ...")
-            reader, writer = await asyncio.open_connection(ip, int(port))
+            reader, writer = await transport.openConnection(ip, port, data=requests[OPC] in (OPT_GET_PIECE, OPT_GET_RAW_PIECE))
             print("Connected as leecher: " + self.src_ip + ":" + self.src_port + ".")
 
-        except ConnectionError:
+        except OSError:
+            # The rest of the swarm can still serve the piece, so just forget this peer
             print("Connection Error: unable to connect to peer.")
-            sys.exit(-1) # different exit number can be used, eg) errno library
+            self.dropPeer(self.createPeerIDFor(ip, port))
+            return -1
 
-        await self.send(writer, requests)
-        res = await self.receive(reader)
+        try:
+            await self.send(writer, requests)
+            if requests[OPC] == OPT_GET_RAW_PIECE:
+                res = await self.receivePiece(reader, self.createPeerIDFor(ip, port))
+            else:
+                res = await self.receive(reader)
+        except (OSError, ValueError, KeyError, asyncio.IncompleteReadError):
+            # The peer closed mid-response or sent garbage, the rest of the swarm can still serve us
+            print("[PEER] Peer at " + ip + ":" + port + " sent an incomplete or invalid response, dropping it.")
+            self.dropPeer(self.createPeerIDFor(ip, port))
+            res = -1
         writer.close()
+        return res
 
     async def receiveRequest(self, reader, writer):
         """
         Handle incoming PEER requests and returns the appropriate response object
         """
+        addr = writer.get_extra_info('peername')
+        span = profiling.Span('peer', addr)
         try:
-            data = await reader.read(READ_SIZE)
-
-            peerRequest = json.loads(data.decode())
-            addr = writer.get_extra_info('peername')
+            peerRequest = await framing.readMessage(reader, span=span)
+            span.opc = peerRequest[OPC]
 
             print(f"\n[PEER] Debug received {peerRequest!r} from {addr!r}.")
+            if peerRequest[OPC] == OPT_GET_RAW_PIECE:
+                await self.sendPiece(writer, peerRequest)
+                span.mark('write')
+                span.finish()
+                writer.close()
+                return
+
             response = self.handlePeerRequest(peerRequest)
+            span.mark('handle')
             payload = json.dumps(response)
+            span.mark('encode')
             print("[PEER] Debug send payload:", payload)
-            writer.write(payload.encode())
+            if peerRequest[OPC] == OPT_GET_PIECE:
+                await self.upload_limiter.throttle(addr[0] if addr else None, len(payload))
+            writer.write(payload.encode() + b'\n')
             await writer.drain()
+            span.mark('write')
+            span.finish()
             print("[PEER] Closing the connection for", addr)
         except:
+            span.finish('failed')
             print("[PEER] Peer", writer.get_extra_info('peername'), "has disconnected.")
         
         writer.close() 
 
+    async def startServing(self):
+        """
+        Starts answering peer requests if we aren't already. Leechers serve the pieces they have while downloading.
+        """
+        if self.server is None:
+            self.server = await transport.startServer(self.receiveRequest, self.src_ip, self.src_port, data=True)
+        return self.server
+
+    async def stopServing(self):
+        if self.server is not None:
+            server = self.server
+            self.server = None
+            server.close()
+            await server.wait_closed()
+
     async def startSeeding(self):
         """
         Once a client begins seeding, we need to open and host a connection as a 'server'
         """
-        server = await asyncio.start_server(self.receiveRequest, self.src_ip, self.src_port)
+        server = await self.startServing()
         if (server is None):
             return
         addr = server.sockets[0].getsockname()
         print(f'[PEER] SEEDING !!! ... Serving on {addr}\n')
-        loop = asyncio.get_event_loop()
-        async with server:
-            try: 
-                await server.serve_forever()
-            except:
-                pass
-            finally:
-                server.close()
-                await server.wait_closed()
+        pex = asyncio.ensure_future(self.pexLoop())
+        try: 
+            await server.serve_forever()
+        except:
+            pass
+        finally:
+            pex.cancel()
+            await self.stopServing()
+            print("[PEER] Piece cache:", piece_cache.getStats())
 
     async def receive(self, reader):
         """
         Handle incoming RESPONSE messages and decode to the JSON object.
         Pass the JSON object to handleRequest() that will handle the request appropriately.
         """
-        data = await reader.read(READ_SIZE)
-        payload = json.loads(data.decode())
-        print(f'[PEER] Received decoded message: {payload!r}\n')
+        payload = await self.receivePayload(reader)
         opc = payload[OPC]
         if opc > 9:
             res = await self.handleServerResponse(payload)
@@ -122,13 +219,165 @@ class Client:
         return res
     
 
+    async def receivePayload(self, reader) -> dict:
+        """
+        Receive a RESPONSE message and decode it to the JSON object without handling it.
+        """
+        payload = await framing.readMessage(reader)
+        print(f'[PEER] Received decoded message: {payload!r}\n')
+        return payload
+
+    async def sendPiece(self, writer, request:dict):
+        """
+        Answer OPT_GET_RAW_PIECE: a small JSON header line, then the piece bytes sent straight from
+        the seeded file with sendfile, so the piece itself is never copied through Python.
+        If the leecher offered a codec and the piece compresses well, the compressed piece is sent instead.
+        Popular pieces are sent from the shared piece cache.
+        """
+        idx = request[PIECE_IDX]
+        peer = self.createPeerIDFor(request[IP], request[PORT])
+        # Upload limits are per connecting address, the IP and PORT a request claims can be anything
+        addr = writer.get_extra_info('peername')
+        limiterKey = addr[0] if addr else None
+        header = {OPC: OPT_GET_RAW_PIECE, PIECE_IDX: idx}
+        if self.super_seeding:
+            # Leechers only send their bitfield to seeders that say they are super-seeding
+            header[SUPER_SEEDING] = 1
+            idx = header[PIECE_IDX] = self.superSeedPiece(peer, request)
+            if idx is None:
+                header[PIECE_IDX] = request[PIECE_IDX]
+                header[RET] = RET_CHOKED
+                writer.write(json.dumps(header).encode() + b'\n')
+                await writer.drain()
+                return
+
+        if not self.piece_buffer.checkIfHavePiece(idx):
+            header[RET] = RET_FAIL
+            writer.write(json.dumps(header).encode() + b'\n')
+            await writer.drain()
+            return
+
+        codec = compression.chooseCodec(request.get(CODECS, []))
+        if self.isIncompressible(idx):
+            codec = compression.CODEC_NONE
+        key = self.pieceCacheKey(idx, codec)
+        frame = piece_cache.get(key)
+        if frame is None and codec != compression.CODEC_NONE:
+            frame = await self.encodePiece(idx, codec)
+            if frame[0] == compression.CODEC_NONE:
+                # Not worth compressing, sent from memory this once and with sendfile from now on
+                self.incompressible[idx >> 3] |= 1 << (idx & 7)
+            elif piece_cache.admits(key, len(frame[1])):
+                piece_cache.put(key, *frame)
+        if frame is not None:
+            codec, data = frame
+            if codec != compression.CODEC_NONE:
+                header[CODEC] = codec
+            header[PIECE_LEN] = len(data)
+            header[RET] = RET_SUCCESS
+            await self.upload_limiter.throttle(limiterKey, len(data))
+            writer.write(json.dumps(header).encode() + b'\n')
+            writer.write(data)
+            await writer.drain()
+            return
+
+        data = None
+        if self.seed_path is not None:
+            segments = self.pieceSegments(idx)
+            length = sum(segLength for _, _, segLength in segments)
+            if piece_cache.admits(key, length):
+                # Worth keeping in memory, read it once rather than sendfile it for every request
+                data = await self.readPiece(idx)
+                piece_cache.put(key, compression.CODEC_NONE, data)
+        else:
+            data = base64.b64decode(self.piece_buffer.getData(idx))
+            length = len(data)
+
+        header[PIECE_LEN] = length
+        header[RET] = RET_SUCCESS
+        await self.upload_limiter.throttle(limiterKey, length)
+        writer.write(json.dumps(header).encode() + b'\n')
+
+        if data is None:
+            # A piece of a directory torrent may span several files, each part is sent from its own file
+            for path, fileOffset, segLength in segments:
+                with open(path, "rb") as seed_file:
+                    await transport.sendFile(writer, seed_file, fileOffset, segLength)
+        else:
+            writer.write(data)
+        await writer.drain()
+
+    async def receivePiece(self, reader, peer_id=None) -> int:
+        """
+        Receive an OPT_GET_RAW_PIECE response and add the piece to the piece buffer.
+        """
+        header = json.loads((await reader.readline()).decode())
+        if header.get(SUPER_SEEDING) and peer_id is not None:
+            self.super_seeders.add(peer_id)
+        if header[RET] == RET_CHOKED:
+            return RET_CHOKED
+        if header[RET] != RET_SUCCESS:
+            return -1
+        # Pieces, and compressed pieces which are only sent when smaller, never exceed PIECE_SIZE
+        if not 0 < header[PIECE_LEN] <= PIECE_SIZE:
+            raise ValueError("invalid piece length " + str(header[PIECE_LEN]))
+
+        # Not reading the socket while throttled lets TCP flow control slow the sender down
+        await self.download_limiter.throttle(peer_id, header[PIECE_LEN])
+        data = await reader.readexactly(header[PIECE_LEN])
+        data = compression.decompress(header.get(CODEC, compression.CODEC_NONE), data)
+        if not self.verifyPiece(header[PIECE_IDX], data):
+            print("[PEER] Piece", header[PIECE_IDX], "failed its hash check, discarding it.")
+            return -1
+        newPiece = Piece(header[PIECE_IDX], base64.b64encode(data).decode(fd.ENCODING))
+        return self.piece_buffer.addData(newPiece)
+
+    async def readPiece(self, idx:int) -> bytes:
+        """
+        Returns the raw bytes of an owned piece, from the seeded file when there is one.
+        """
+        if self.seed_path is not None:
+            return await fd.readPieceAsync(self.seed_path, idx, self.manifest)
+        return base64.b64decode(self.piece_buffer.getData(idx))
+
+    async def encodePiece(self, idx:int, codec:str) -> tuple:
+        """
+        Returns (codec, bytes) for a piece, compressed with codec unless it isn't worth it.
+        """
+        data = await self.readPiece(idx)
+        loop = asyncio.get_event_loop()
+        compressed = await loop.run_in_executor(None, compression.compressPiece, data, codec)
+        if compressed is None:
+            return compression.CODEC_NONE, data
+        return codec, compressed
+
+    def isIncompressible(self, idx:int) -> bool:
+        return idx >> 3 < len(self.incompressible) and bool(self.incompressible[idx >> 3] & (1 << (idx & 7)))
+
+    def pieceSegments(self, idx:int) -> [tuple]:
+        """
+        Returns the (file path, offset, length) parts of a piece of the seeded file or directory.
+        """
+        if self.manifest is None:
+            offset = idx * PIECE_SIZE
+            return [(self.seed_path, offset, min(PIECE_SIZE, os.path.getsize(self.seed_path) - offset))]
+        return [(os.path.join(self.seed_path, path), offset, length) for path, offset, length in fd.pieceSegments(self.manifest, idx)]
+
+    def pieceCacheKey(self, idx:int, codec:str) -> tuple:
+        """
+        Pieces are cached by digest, shared with every torrent holding the same piece.
+        """
+        if self.piece_hashes:
+            return self.piece_hashes[idx], codec
+        return self.peer_id, self.seed_path, idx, codec
+
     async def send(self, writer, payload:dict):
         """
         Encode the payload to an encoded JSON object and send to the appropriate client/server
         """
         jsonPayload = json.dumps(payload)
         print("[PEER] Sending encoded request message:", (jsonPayload))
-        writer.write(jsonPayload.encode())
+        writer.write(jsonPayload.encode() + b'\n')
     
 
 ########### REQUEST & RESPONSE HANDLING ###########
@@ -154,6 +403,9 @@ class Client:
         elif ret == RET_TORRENT_DOES_NOT_EXIST:
             print("[PEER] GET TORRENT FAIL: The torrent ID does not exist")
             return -1
+        elif ret == RET_RETRY_LATER:
+            print("[PEER] TRACKER BUSY: please retry in", response[RETRY_AFTER], "seconds.")
+            return -1
 
         # If RET_SUCCESS, handle the response payload based on OPC
         if opc == OPT_GET_LIST:
@@ -162,16 +414,28 @@ class Client:
             print("TID \t FILE_NAME \t TOTAL_PIECES \t SEEDERS \t")
             print("--- \t -------- \t ------------ \t ------- \t")
             for idx, curr_torrent in enumerate(torrent_list):
-                print(curr_torrent[TID], '\t', curr_torrent[FILE_NAME], '\t',  curr_torrent[TOTAL_PIECES], '\t\t', curr_torrent[SEEDER_LIST], '\n')
+                print(curr_torrent[TID], '\t', curr_torrent[FILE_NAME], '\t',  curr_torrent[TOTAL_PIECES], '\t\t', self.getSeedersFrom(curr_torrent), '\n')
             print("\n///////////////////////////////////////////////////////////////////////////////////////////////////\n")
             return RET_SUCCESS
         elif opc == OPT_GET_TORRENT:
             torrent = response[TORRENT]
             self.peer_am_leeching = True
-            self.seeders_list = torrent[SEEDER_LIST]
+            self.tid = torrent[TID]
+            self.seeders_list = self.getSeedersFrom(torrent)
+            self.content_hash = torrent.get(CONTENT_HASH)
+            self.piece_hashes = fd.unpackHashes(torrent[PIECE_HASHES]) if torrent.get(PIECE_HASHES) else []
+            self.manifest = torrent.get(MANIFEST)
+            if self.manifest is not None:
+                try:
+                    fd.checkManifest(self.manifest, torrent[TOTAL_PIECES])
+                except ValueError as e:
+                    print("[PEER] Refusing torrent", self.tid, ":", e)
+                    return RET_FAIL
             self.piece_buffer.setBuffer(torrent[TOTAL_PIECES])
+            self.incompressible = bytearray((torrent[TOTAL_PIECES] + 7) // 8)
             #we immediately start the downloading process upon receiving the torrent object
-            await self.downloadFile(torrent[TOTAL_PIECES], torrent[FILE_NAME])
+            if not await self.downloadFile(torrent[TOTAL_PIECES], torrent[FILE_NAME]):
+                return RET_FAIL
             return RET_FINISHED_DOWNLOAD    
         elif opc == OPT_START_SEED or opc == OPT_UPLOAD_FILE:
             self.peer_am_leeching = False
@@ -185,25 +449,32 @@ class Client:
 
         return 1
 
-    def createServerRequest(self, opc:int, torrent_id=None, filename=None) -> dict:
+    def createServerRequest(self, opc:int, torrent_id=None, filename=None, num_pieces=0) -> dict:
         """
         Called from client_handler.py to create the appropriate server request given the op code
+        For OPT_UPLOAD_FILE the file must first be loaded with uploadFile(), num_pieces is its result.
         Returns a dictionary of our payload.
         """
         payload = {OPC:opc, IP:self.src_ip, PORT:self.src_port, PID:self.peer_id}
         # get list of torrents is default payload as above
 
+        if opc == OPT_GET_LIST or opc == OPT_GET_TORRENT:
+            payload[COMPACT] = 1
+            payload[NUMWANT] = DEFAULT_NUMWANT
+
         if opc == OPT_GET_TORRENT or opc == OPT_START_SEED or opc == OPT_STOP_SEED:
             payload[TID] = torrent_id
         elif opc == OPT_UPLOAD_FILE:
-            numPieces = self.uploadFile(filename)
-            
             # NOTE: hacky way to handle the invalid file exception
-            if numPieces == 0:
+            if num_pieces == 0:
                 return {}
 
-            payload[FILE_NAME] = self.fileStrip(filename)
-            payload[TOTAL_PIECES] = numPieces
+            payload[FILE_NAME] = self.fileStrip(filename.rstrip('/'))
+            payload[TOTAL_PIECES] = num_pieces
+            payload[CONTENT_HASH] = self.content_hash
+            payload[PIECE_HASHES] = fd.packHashes(self.piece_hashes)
+            if self.manifest is not None:
+                payload[MANIFEST] = self.manifest
 
         return payload
 
@@ -218,7 +489,10 @@ class Client:
             return -1
         
         if opc == OPT_GET_PEERS:
-            self.seeders_list = response[PEER_LIST]
+            if PEERS_ADDED in response:
+                self.mergePeers(response[PEERS_ADDED], response[PEERS_DROPPED], response[PID])
+            else:
+                self.seeders_list = response[PEER_LIST]
         elif opc == OPT_GET_PIECE:
             data = response[PIECE_DATA]
             idx = response[PIECE_IDX]
@@ -235,30 +509,301 @@ class Client:
         response = {OPC: opc, IP:self.src_ip, PORT:self.src_port}
 
         if opc == OPT_GET_PEERS:
-            response[PEER_LIST] = self.seeders_list
-            response[RET] = RET_SUCCESS
+            if PID not in request:
+                # Legacy request, reply with the full peer list
+                response[PEER_LIST] = self.seeders_list
+                response[RET] = RET_SUCCESS
+            elif request.get(TID) != self.tid:
+                response[RET] = RET_FAIL
+            else:
+                # Incremental exchange: merge what the peer told us, reply with what it has not seen yet
+                self.mergePeers(request[PEERS_ADDED], request[PEERS_DROPPED], request[PID])
+                added, dropped = self.getPexDelta(request[PID])
+                response[PID] = self.peer_id
+                response[PEERS_ADDED] = added
+                response[PEERS_DROPPED] = dropped
+                response[RET] = RET_SUCCESS
         elif opc == OPT_GET_PIECE:
             piece_idx = request[PIECE_IDX]
             if self.piece_buffer.checkIfHavePiece(piece_idx):
-                response[PIECE_DATA] = self.piece_buffer.getData(piece_idx)
+                if self.seed_path is not None:
+                    response[PIECE_DATA] = base64.b64encode(fd.readPiece(self.seed_path, piece_idx, self.manifest)).decode(fd.ENCODING)
+                else:
+                    response[PIECE_DATA] = self.piece_buffer.getData(piece_idx)
                 response[PIECE_IDX] = request[PIECE_IDX]
                 response[RET] = RET_SUCCESS
             else:
                 response[RET] = RET_FAIL
         return response
         
-    def createPeerRequest(self, opc:int, piece_idx=None) -> dict:
+    def createPeerRequest(self, opc:int, piece_idx=None, peer_id=None) -> dict:
         """
         Create the appropriate peer request.
+        peer_id is the id of the receiving peer, required for an incremental OPT_GET_PEERS exchange
+        and used to send our bitfield with OPT_GET_RAW_PIECE to super-seeders.
         """
         payload = {OPC:opc, IP:self.src_ip, PORT:self.src_port}
 
         if opc == OPT_GET_PIECE:
             payload[PIECE_IDX] = piece_idx
+        elif opc == OPT_GET_RAW_PIECE:
+            payload[PIECE_IDX] = piece_idx
+            payload[CODECS] = self.codecs
+            if peer_id in self.super_seeders:
+                # Tell the super-seeder what we have, it picks the piece to send from it
+                payload[HAVE_BITFIELD] = base64.b64encode(self.piece_buffer.getBitfield()).decode()
+        elif opc == OPT_GET_PEERS and peer_id is not None:
+            added, dropped = self.getPexDelta(peer_id)
+            payload[PID] = self.peer_id
+            payload[TID] = self.tid
+            payload[PEERS_ADDED] = added
+            payload[PEERS_DROPPED] = dropped
         
         return payload
 
 
+########### PEER EXCHANGE ###########
+
+    def getPexDelta(self, peer_id: str):
+        """
+        Returns the (added, dropped) peers since the last exchange with peer_id, and records
+        the current view as sent. The peer itself is never advertised back to it.
+        """
+        view = dict(self.seeders_list)
+        if self.peer_am_seeding or self.server is not None:
+            view[self.peer_id] = {IP: self.src_ip, PORT: self.src_port}
+        view.pop(peer_id, None)
+
+        known = self.pex_known.get(peer_id, set())
+        added = {pid: peer for pid, peer in view.items() if pid not in known}
+        dropped = [pid for pid in known if pid not in view]
+        self.pex_known[peer_id] = set(view)
+        return added, dropped
+
+    def mergePeers(self, added: dict, dropped: list, source=None):
+        """
+        Merges an incremental peer exchange into the seeders list. Peers learned from source
+        are marked as known to it so they aren't echoed back on the next exchange.
+        """
+        known = self.pex_known.setdefault(source, set()) if source is not None else set()
+        for pid, peer in added.items():
+            if pid != self.peer_id:
+                self.seeders_list[pid] = peer
+            if pid != source:
+                known.add(pid)
+        for pid in dropped:
+            self.seeders_list.pop(pid, None)
+            known.discard(pid)
+            self.forgetPeerHave(pid)
+
+    def dropPeer(self, peer_id: str):
+        """
+        Forgets an unreachable peer, it will be reported as dropped on the next exchange.
+        Its bitfield stops counting towards super-seeding.
+        """
+        self.seeders_list.pop(peer_id, None)
+        self.pex_known.pop(peer_id, None)
+        self.forgetPeerHave(peer_id)
+
+    async def exchangeWithPeer(self, peer_id: str, peer: dict):
+        """
+        Runs one incremental OPT_GET_PEERS exchange with a single peer. Peers that don't answer
+        within PEX_TIMEOUT are dropped.
+        """
+        try:
+            reader, writer = await asyncio.wait_for(transport.openConnection(peer[IP], peer[PORT]), PEX_TIMEOUT)
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            print("[PEER] PEX: peer", peer_id, "is unreachable, dropping it.")
+            self.dropPeer(peer_id)
+            return
+
+        try:
+            await self.send(writer, self.createPeerRequest(OPT_GET_PEERS, peer_id=peer_id))
+            await asyncio.wait_for(self.receive(reader), PEX_TIMEOUT)
+        except asyncio.TimeoutError:
+            print("[PEER] PEX: peer", peer_id, "timed out, dropping it.")
+            self.dropPeer(peer_id)
+        except (ConnectionError, ValueError, KeyError):
+            print("[PEER] PEX: exchange with peer", peer_id, "failed.")
+            # Resend the full view next time since we don't know what the peer has seen
+            self.pex_known.pop(peer_id, None)
+        writer.close()
+
+    async def exchangePeers(self):
+        """
+        Gossips with up to PEX_MAX_PEERS known peers of the current torrent at once, picked at random
+        so every peer is reached over a few rounds.
+        """
+        peers = [(pid, peer) for pid, peer in self.seeders_list.items() if pid != self.peer_id]
+        if len(peers) > PEX_MAX_PEERS:
+            peers = random.sample(peers, PEX_MAX_PEERS)
+        await asyncio.gather(*[self.exchangeWithPeer(pid, peer) for pid, peer in peers])
+
+    async def pexLoop(self):
+        """
+        Periodically exchanges peers while seeding.
+        """
+        while self.peer_am_seeding:
+            await asyncio.sleep(PEX_INTERVAL)
+            await self.exchangePeers()
+
+    async def requestTracker(self, payload: dict) -> dict:
+        """
+        Sends one request to the tracker and returns its response without handling it. Requests the
+        tracker refuses while busy are retried after the delay it asks for, with some random jitter
+        so refused clients don't all come back at once.
+        """
+        for attempt in range(TRACKER_RETRIES + 1):
+            reader, writer = await self.connectToTracker(self.tracker_ip, self.tracker_port)
+            await self.send(writer, payload)
+            response = await self.receivePayload(reader)
+            writer.close()
+            if response[RET] != RET_RETRY_LATER or attempt == TRACKER_RETRIES:
+                return response
+            await asyncio.sleep(response[RETRY_AFTER] * (1 + random.random()))
+
+    async def refreshPeersFromTracker(self):
+        """
+        Fetches the seeders list from the tracker, used only when the swarm has run dry.
+        """
+        print("[PEER] Swarm ran dry, asking the tracker for peers.")
+        try:
+            response = await self.requestTracker(self.createServerRequest(OPT_GET_TORRENT, torrent_id=self.tid))
+        except ConnectionError:
+            return
+        if response[RET] == RET_SUCCESS:
+            self.mergePeers(self.getSeedersFrom(response[TORRENT]), [])
+
+
+########### SUPER SEEDING ###########
+
+    def superSeedPiece(self, peer_id: str, request: dict):
+        """
+        Picks the piece to send peer_id in answer to a piece request, or None to refuse it.
+        A peer gets one piece at a time, and a new one only once its last piece was seen at another peer.
+        """
+        if HAVE_BITFIELD not in request:
+            # The peer doesn't know we are super-seeding yet, the choke tells it to send its bitfield
+            return None
+
+        self.expireSuperSeedPeers()
+        have = self.updatePeerHave(peer_id, base64.b64decode(request[HAVE_BITFIELD]))
+
+        if peer_id in self.super_assigned:
+            assigned, assignedAt = self.super_assigned[peer_id]
+            if not have.checkIfHavePiece(assigned):
+                return assigned
+            if not self.isPieceSpread(assigned, peer_id) and time.monotonic() - assignedAt < SUPER_SEED_RELEASE:
+                return None
+
+        idx = self.pickSuperSeedPiece(have, request[PIECE_IDX])
+        if idx is not None:
+            self.super_assigned[peer_id] = (idx, time.monotonic())
+            if idx not in self.super_owner:
+                self.super_owner[idx] = peer_id
+                if not self.super_holders[idx]:
+                    self.super_unspread.add(idx)
+        return idx
+
+    def resetSuperSeeding(self):
+        """
+        Starts super-seeding the pieces in the piece buffer afresh.
+        """
+        numPieces = self.piece_buffer.getSize()
+        self.peer_have.clear()
+        self.peer_seen.clear()
+        self.super_assigned.clear()
+        self.super_owner.clear()
+        self.super_holders = [0] * numPieces
+        self.super_unspread = set()
+        self.super_next = 0
+
+    def updatePeerHave(self, peer_id: str, bitfield: bytes):
+        """
+        Stores a peer's bitfield and updates the per-piece holder counts with the pieces it gained or lost.
+        """
+        have = self.peer_have.get(peer_id)
+        if have is None:
+            have = self.peer_have[peer_id] = PieceBuffer()
+            old = 0
+        else:
+            old = int.from_bytes(have.getBitfield(), 'little')
+        have.setBitfield(self.piece_buffer.getSize(), bitfield)
+        self.peer_seen[peer_id] = time.monotonic()
+        self.peer_seen.move_to_end(peer_id)
+
+        new = int.from_bytes(have.getBitfield(), 'little')
+        changed = old ^ new
+        while changed:
+            bit = changed & -changed
+            idx = bit.bit_length() - 1
+            changed ^= bit
+            if new & bit:
+                self.super_holders[idx] += 1
+                if idx in self.super_unspread and self.super_owner[idx] != peer_id:
+                    self.super_unspread.discard(idx)
+            else:
+                self.super_holders[idx] -= 1
+        return have
+
+    def forgetPeerHave(self, peer_id: str):
+        """
+        Stops counting the pieces of a peer that is gone.
+        """
+        have = self.peer_have.pop(peer_id, None)
+        self.peer_seen.pop(peer_id, None)
+        self.super_assigned.pop(peer_id, None)
+        if have is None:
+            return
+        bits = int.from_bytes(have.getBitfield(), 'little')
+        while bits:
+            bit = bits & -bits
+            self.super_holders[bit.bit_length() - 1] -= 1
+            bits ^= bit
+
+    def expireSuperSeedPeers(self):
+        """
+        Forgets peers that stopped asking for pieces, their bitfields are no longer current.
+        """
+        expiry = time.monotonic() - SUPER_SEED_PEER_EXPIRY
+        while self.peer_seen:
+            peer_id, seen = next(iter(self.peer_seen.items()))
+            if seen > expiry:
+                break
+            self.forgetPeerHave(peer_id)
+
+    def isPieceSpread(self, idx: int, owner: str) -> bool:
+        """
+        True once a peer other than the one we handed the piece to reports having it, or if no other peer is known.
+        """
+        ownerHas = owner in self.peer_have and self.peer_have[owner].checkIfHavePiece(idx)
+        if len(self.peer_have) - (owner in self.peer_have) == 0:
+            return True
+        return self.super_holders[idx] - ownerHas > 0
+
+    def pickSuperSeedPiece(self, have, requested: int):
+        """
+        Returns the requested piece if it was never handed out and the peer lacks it, else the next piece
+        never handed out. Once every piece was handed out, the rarest piece the peer lacks.
+        """
+        if have.getHaveCount() == have.getSize():
+            return None
+        if requested not in self.super_owner and not have.checkIfHavePiece(requested):
+            return requested
+
+        # Pieces are handed out in order, the ones before super_next all have an owner
+        numPieces = self.piece_buffer.getSize()
+        while self.super_next < numPieces and self.super_next in self.super_owner:
+            self.super_next += 1
+        for idx in range(self.super_next, numPieces):
+            if idx not in self.super_owner and not have.checkIfHavePiece(idx):
+                return idx
+
+        if len(self.super_owner) == numPieces and (not self.super_unspread or len(self.peer_have) <= 1):
+            print("[PEER] Every piece has spread through the swarm, leaving super-seeding mode.")
+            self.super_seeding = False
+        return min(have.iterMissingPieces(), key=self.super_holders.__getitem__)
+
 ########### HELPER FUNCTIONS ###########
 
     # NOT USED
@@ -276,35 +821,82 @@ class Client:
             request = self.createPeerRequest(OPT_GET_PIECE, idx)
             await self.connectToPeer(initialPeer_ip, initialPeer_port, request)
         
-    async def evenPeerSelection(self, numPieces:int):
+    async def evenPeerSelection(self, pieces:[int]) -> int:
         """
-        Evenly distributes the piece requests among available peers
+        Evenly distributes the requests for the given piece indices among available peers. A piece
+        its peer can't send is asked of the next peers in turn, since leechers only hold some pieces.
+        Returns how many requests a super-seeder choked.
         """
         numPeers = len(self.seeders_list)
 
         peerList = []             # Add peers to a list
-        requests_list = []        # Add requests to a list
 
-        for peer in self.seeders_list.values():
-            peerList.append(peer)
-        for i in range(numPieces):
-            requests_list.append(self.createPeerRequest(OPT_GET_PIECE, i))
+        for pid, peer in self.seeders_list.items():
+            peerList.append((pid, peer))
         
+        choked = 0
         currPiece = 0
-        while (currPiece < numPieces):
-            currPeer = currPiece % numPeers
-            await self.connectToPeer(peerList[currPeer][IP], peerList[currPeer][PORT], requests_list[currPiece])
+        while (currPiece < len(pieces)):
+            for attempt in range(numPeers):
+                # Requests are built as they are sent, so they carry our latest bitfield. A super-seeder
+                # may also have sent us a different piece than asked, making a later request unnecessary.
+                if self.piece_buffer.checkIfHavePiece(pieces[currPiece]):
+                    break
+                pid, peer = peerList[(currPiece + attempt) % numPeers]
+                if pid not in self.seeders_list:
+                    continue        # dropped as unreachable earlier in this pass
+                request = self.createPeerRequest(OPT_GET_RAW_PIECE, pieces[currPiece], peer_id=pid)
+                if await self.connectToPeer(peer[IP], peer[PORT], request) == RET_CHOKED:
+                    choked += 1
             currPiece +=1   
+        return choked
         
-    async def downloadFile(self, numPieces:int, filename:str):
+    async def downloadFile(self, numPieces:int, filename:str) -> bool:
         """
         Method for starting the download of a file by calling the peer selection method to download pieces
         Once done, output it to the output directory with peer_id appended to the filename.
+        Returns False if the file could not be completed.
         """
-        await self.evenPeerSelection(numPieces)
+        # Pieces we already hold under another torrent don't need to be fetched
+        await self.reuseStoredPieces()
+
+        # Serve the pieces we get to the rest of the swarm while downloading, and learn about it
+        # from the seeders the tracker gave us
+        if not self.piece_buffer.checkIfHaveAllPieces():
+            await self.startServing()
+            await self.exchangePeers()
+
+        # Pieces that failed in one round are requested again, from a refreshed swarm
+        stalled = 0
+        chokedSince = None
+        while not self.piece_buffer.checkIfHaveAllPieces() and stalled < DOWNLOAD_ROUNDS:
+            if not self.seeders_list:
+                await self.refreshPeersFromTracker()
+            if not self.seeders_list:
+                print("[PEER] No seeders available for torrent", self.tid)
+                break
+
+            haveCount = self.piece_buffer.getHaveCount()
+            choked = await self.evenPeerSelection(self.piece_buffer.getMissingPieces())
+            if self.piece_buffer.checkIfHaveAllPieces():
+                break
+            if self.piece_buffer.getHaveCount() > haveCount:
+                stalled = 0
+                chokedSince = None
+            else:
+                # A super-seeder holds pieces back until ours spread, or for up to SUPER_SEED_RELEASE.
+                # Being choked is a reason to wait, not a failed pass, until that window has gone by.
+                if choked and chokedSince is None:
+                    chokedSince = time.monotonic()
+                if not choked or time.monotonic() - chokedSince > SUPER_SEED_RELEASE:
+                    stalled += 1
+                await asyncio.sleep(DOWNLOAD_BACKOFF)
+            await self.exchangePeers()
 
-        while not self.piece_buffer.checkIfHaveAllPieces:
-            continue
+        if not self.piece_buffer.checkIfHaveAllPieces():
+            print("[PEER] Download incomplete, missing pieces:", self.piece_buffer.getMissingPieces())
+            await self.stopServing()
+            return False
         
         pieces2file = []
         outputDir = 'output/' + self.peer_id + '_' + filename
@@ -312,41 +904,90 @@ class Client:
             pieces2file.append(self.piece_buffer.getData(i))
 
         try:
-            fd.decodeToFile(pieces2file, outputDir)
+            await fd.decodeToFileAsync(pieces2file, outputDir, self.manifest)
+            self.seed_path = outputDir
+            self.piece_buffer.dropData()
+            piece_store.addFile(outputDir, self.piece_hashes, self.manifest)
             print("[PEER] Successfully downloaded file: ", outputDir)
         except:
             print("Exception occured in downloadFile() with filename:", filename)
+            return False
+        return True
         
 
-    def uploadFile(self, filename: str) -> int:
+    async def uploadFile(self, filename: str) -> int:
         """
         Called when the user begins to be the initial seeder (upload a file). The piecebuffer will be
-        populated and initialized.
+        initialized with every piece owned. A directory is uploaded as one torrent of all the files under it.
         Returns the number of pieces in the created piece buffer.
         """
-        pieces = []
-        numPieces = 0
         try:
-            pieces, numPieces = fd.encodeToBytes(filename)
+            self.manifest = fd.buildManifest(filename) if os.path.isdir(filename) else None
+            self.content_hash, self.piece_hashes = await fd.hashFileAsync(filename, self.manifest)
         except:
             print("Exception occured in uploadFile() with filename:", '\''+filename+'\'', ", please check your filename or directory.")
             return 0
            
-        # Set the buffer size and add the file's data to the buffer.
-        self.piece_buffer.setBuffer(numPieces)
+        # Pieces are read from the file when served, the buffer only records that we have all of them
+        numPieces = len(self.piece_hashes)
+        self.piece_buffer.setBitfield(numPieces, b'\xff' * ((numPieces + 7) // 8))
+        self.incompressible = bytearray((numPieces + 7) // 8)
+        self.seed_path = filename
+        piece_store.addFile(filename, self.piece_hashes, self.manifest)
 
-        for idx in range(len(pieces)):
-            currPiece = Piece(idx, pieces[idx])
-            self.piece_buffer.addData(currPiece)      
+        # Only the initial seeder super-seeds, it starts out as the only source of every piece
+        self.super_seeding = self.super_seed
+        self.resetSuperSeeding()
 
         return numPieces
 
+    def verifyPiece(self, idx: int, data: bytes) -> bool:
+        """
+        Checks a received piece against its hash from the torrent, if the torrent has piece hashes.
+        """
+        if not self.piece_hashes:
+            return True
+        return 0 <= idx < len(self.piece_hashes) and hashlib.sha1(data).digest() == self.piece_hashes[idx]
+
+    async def reuseStoredPieces(self):
+        """
+        Fills the piece buffer with pieces found in the shared content-addressed piece store.
+        """
+        reused = 0
+        for idx, digest in enumerate(self.piece_hashes):
+            if self.piece_buffer.checkIfHavePiece(idx):
+                continue
+            data = await piece_store.read(digest)
+            if data is not None:
+                self.piece_buffer.addData(Piece(idx, base64.b64encode(data).decode(fd.ENCODING)))
+                reused += 1
+        if reused:
+            print("[PEER] Reused", reused, "pieces already on disk.")
+
     def createPeerID(self) -> str:
         """
         Ideally, create a unique peer ID.
         Uses src_ip + src_port and MD5 hash -> hexadecimal string as an ID.
         """
-        hashString = self.src_ip+self.src_port
+        return self.createPeerIDFor(self.src_ip, self.src_port)
+
+    def getSeedersFrom(self, torrent: dict) -> dict:
+        """
+        Returns the seeders of a tracker torrent dict keyed by peer id, whether it holds compact or full peer lists.
+        """
+        if COMPACT_SEEDERS not in torrent:
+            return torrent[SEEDER_LIST]
+        peers = peerlist.unpackPeers(torrent[COMPACT_SEEDERS], torrent[COMPACT_SEEDERS6])
+        seeders = {self.createPeerIDFor(ip, port): {IP: ip, PORT: port} for ip, port in peers}
+        # Seeders known by host name can't be packed and come as per-peer dicts alongside
+        seeders.update(torrent.get(SEEDER_LIST, {}))
+        return seeders
+
+    def createPeerIDFor(self, ip, port) -> str:
+        """
+        Returns the peer ID of the peer listening at ip:port.
+        """
+        hashString = ip+port
         return hashlib.md5(hashString.encode()).hexdigest()
 
     def fileStrip(self, filename) -> str:
@@ -376,13 +1017,15 @@ class Piece:
 
 class PieceBuffer:
     """
-    A piece manager that handles the current piece buffer for the requested file
+    A piece manager that handles the current piece buffer for the requested file.
+    Owned pieces are tracked in a bitset with a running count, so completion checks are constant-time.
     """
 
     def __init__(self):
         self.__buffer = []
         self.__size = 0
-        self.__havePieces = []
+        self.__havePieces = bytearray()
+        self.__haveCount = 0
     
     def getBuffer(self):
         return self.__buffer
@@ -393,7 +1036,8 @@ class PieceBuffer:
         """
         self.__buffer = [0] * length
         self.__size = length
-        self.__havePieces = [False] * length
+        self.__havePieces = bytearray((length + 7) // 8)
+        self.__haveCount = 0
 
     def addData(self, piece: Piece) -> int:
         idx = piece.index
@@ -401,38 +1045,73 @@ class PieceBuffer:
         if idx < 0 or idx >= self.__size:
             return -1
         else:
-            self.__buffer[idx] = data
-            self.__havePieces[idx] = True
+            if idx < len(self.__buffer):
+                self.__buffer[idx] = data
+            if not self.checkIfHavePiece(idx):
+                self.__havePieces[idx >> 3] |= 1 << (idx & 7)
+                self.__haveCount += 1
             return 1
 
     def getData(self, idx: int):
         """
         Returns the piece bytes at the specified index.
         """
-        if idx < 0 or idx >= self.__size or self.__buffer[idx] == 0:
+        if idx < 0 or idx >= len(self.__buffer) or self.__buffer[idx] == 0:
             return -1
         else:
             return self.__buffer[idx]
+
+    def dropData(self):
+        """
+        Frees the piece bytes once they can be read back from the seeded file, keeping which pieces are owned.
+        """
+        self.__buffer = []
             
     def getSize(self) -> int:
         return self.__size
 
+    def getHaveCount(self) -> int:
+        return self.__haveCount
+
     def getMissingPieces(self) -> [int]:
-        missingPieces = []
-        for idx, pce in enumerate(self.__havePieces):
-            if not pce:
-                missingPieces.append(idx)
-        return missingPieces
+        return list(self.iterMissingPieces())
+
+    def iterMissingPieces(self):
+        """
+        Yields the indices of missing pieces, skipping over fully owned bytes of the bitset.
+        """
+        for byteIdx, bits in enumerate(self.__havePieces):
+            if bits == 0xFF:
+                continue
+            for bit in range(8):
+                idx = (byteIdx << 3) + bit
+                if idx >= self.__size:
+                    return
+                if not (bits >> bit) & 1:
+                    yield idx
     
     def checkIfHavePiece(self, idx:int) -> bool:
-        return self.__havePieces[idx]
+        if idx < 0 or idx >= self.__size:
+            return False
+        return bool((self.__havePieces[idx >> 3] >> (idx & 7)) & 1)
     
     def checkIfHaveAllPieces(self) -> bool:
-        for pce in self.__havePieces:
-            if not pce:
-                return False
-        return True
-    
+        return self.__haveCount == self.__size
 
+    def getBitfield(self) -> bytes:
+        """
+        Returns the owned pieces bitset, bit (idx % 8) of byte (idx // 8) is set for piece idx.
+        """
+        return bytes(self.__havePieces)
 
-    
\ No newline at end of file
+    def setBitfield(self, length: int, bitfield: bytes):
+        """
+        Initialize the buffer as only tracking which pieces a peer has, from its bitfield.
+        """
+        self.setBuffer(length)
+        self.dropData()
+        bits = bytearray(bitfield[:len(self.__havePieces)])
+        if bits and length % 8:
+            bits[-1] &= (1 << (length % 8)) - 1
+        self.__havePieces[:len(bits)] = bits
+        self.__haveCount = bin(int.from_bytes(self.__havePieces, 'little')).count('1')
@@ -4,7 +4,12 @@ Handler class for taking in user's inputs.
 
 from src.client import *
 from src.protocol import *
+import src.transport as transport
+import src.profiling as profiling
+import argparse
 import asyncio
+import json
+import os
 import sys
 
 def handleUserChoice():
@@ -110,11 +115,193 @@ def parseCommandLine():
 
     return src_ip, src_port, dest_ip, dest_port
 
+def parseBatchCommandLine():
+    """
+    Parses the arguments of the headless batch mode, used when any --option is given.
+    Options without any job start the interactive prompt with those settings.
+    """
+    parser = argparse.ArgumentParser(prog='client_handler.py',
+                                     description='Fetch or upload torrents without the interactive prompt. '
+                                                 'Each job runs as its own client on consecutive source ports.')
+    parser.add_argument('src_ip')
+    parser.add_argument('src_port', type=int)
+    parser.add_argument('tracker_ip', nargs='?', default='127.0.0.1')
+    parser.add_argument('tracker_port', nargs='?', default='8888')
+    parser.add_argument('--fetch', type=int, nargs='+', default=[], metavar='TID', help='torrent ids to download')
+    parser.add_argument('--upload', nargs='+', default=[], metavar='FILE', help='files to upload and seed, a directory is seeded as one torrent of all its files')
+    parser.add_argument('--upload-dir', metavar='DIR', help='upload and seed every file in DIR')
+    parser.add_argument('--job', metavar='FILE',
+                        help='JSON job file with any of the keys "fetch", "upload", "upload_dir", "policy"')
+    parser.add_argument('--policy', choices=['exit', 'seed'], default=None,
+                        help='exit once downloads finish, or keep seeding them (default: exit). '
+                             'Uploads are always seeded until interrupted')
+    parser.add_argument('--concurrency', type=int, default=8, help='jobs transferring at once')
+    parser.add_argument('--summary', metavar='FILE', help='also write the JSON summary to FILE')
+    parser.add_argument('--upload-limit', type=int, metavar='KB/S', help='total upload rate limit')
+    parser.add_argument('--download-limit', type=int, metavar='KB/S', help='total download rate limit')
+    parser.add_argument('--peer-upload-limit', type=int, metavar='KB/S', help='upload rate limit to each peer')
+    parser.add_argument('--peer-download-limit', type=int, metavar='KB/S', help='download rate limit from each peer')
+    parser.add_argument('--cache-size', type=int, metavar='MB',
+                        help=f'memory for the piece cache shared by every seeded torrent (default: {PIECE_CACHE_SIZE >> 20})')
+    parser.add_argument('--trace', metavar='FILE', help='append a JSON line per peer request handled, timing each stage')
+    parser.add_argument('--profile', type=float, metavar='SECONDS', help='profile the first SECONDS with cProfile')
+    parser.add_argument('--super-seed', action='store_true',
+                        help='super-seed uploads: hand each leecher one piece at a time until pieces spread')
+    args = parser.parse_args()
+
+    if args.job:
+        with open(args.job) as job_file:
+            job = json.load(job_file)
+        args.fetch += job.get('fetch', [])
+        args.upload += job.get('upload', [])
+        args.upload_dir = args.upload_dir or job.get('upload_dir')
+        args.policy = args.policy or job.get('policy')
+    if args.upload_dir:
+        for name in sorted(os.listdir(args.upload_dir)):
+            path = os.path.join(args.upload_dir, name)
+            if os.path.isfile(path):
+                args.upload.append(path)
+    args.policy = args.policy or 'exit'
+    if args.cache_size is not None:
+        piece_cache.setLimit(args.cache_size << 20)
+    return args
+
+def rateLimits(args) -> dict:
+    """
+    Returns the Client rate limit arguments in bytes per second from the KB/s command line options.
+    """
+    toBytes = lambda limit: limit * 1024 if limit else None
+    return {'upload_rate': toBytes(args.upload_limit),
+            'download_rate': toBytes(args.download_limit),
+            'peer_upload_rate': toBytes(args.peer_upload_limit),
+            'peer_download_rate': toBytes(args.peer_download_limit)}
+
+async def fetchJob(cli, tid, policy, seeding) -> dict:
+    """
+    Downloads one torrent, then registers as its seeder if the policy says so.
+    """
+    summary = {'action': 'fetch', 'tid': tid, 'peer_id': cli.peer_id, 'status': 'failed'}
+    response = await cli.requestTracker(cli.createServerRequest(OPT_GET_TORRENT, torrent_id=tid))
+    result = await cli.handleServerResponse(response)
+    if result != RET_FINISHED_DOWNLOAD:
+        return summary
+
+    summary['status'] = 'downloaded'
+    summary['file'] = cli.seed_path
+    if policy != 'seed':
+        # We served pieces to the swarm while downloading, stop now that we are leaving
+        await cli.stopServing()
+    else:
+        response = await cli.requestTracker(cli.createServerRequest(OPT_START_SEED, torrent_id=tid))
+        if response[RET] == RET_SUCCESS:
+            summary['status'] = 'seeding'
+            seeding.append((cli, asyncio.ensure_future(cli.handleServerResponse(response))))
+    return summary
+
+async def uploadJob(cli, filename, seeding) -> dict:
+    """
+    Uploads one file and starts seeding it.
+    """
+    summary = {'action': 'upload', 'file': filename, 'peer_id': cli.peer_id, 'status': 'failed'}
+    numPieces = await cli.uploadFile(filename)
+    payload = cli.createServerRequest(OPT_UPLOAD_FILE, filename=filename, num_pieces=numPieces)
+    if not payload:
+        return summary
+
+    response = await cli.requestTracker(payload)
+    if response[RET] == RET_SUCCESS:
+        summary['status'] = 'seeding'
+        summary['tid'] = response[TID]
+        seeding.append((cli, asyncio.ensure_future(cli.handleServerResponse(response))))
+    return summary
+
+async def stopSeeding(cli):
+    try:
+        await cli.requestTracker(cli.createServerRequest(OPT_STOP_SEED, torrent_id=cli.tid))
+    except ConnectionError:
+        pass
+
+async def requestOrExit(cli, payload) -> dict:
+    """
+    Sends one request from the interactive client to the tracker, exiting if it can't be reached.
+    """
+    try:
+        return await cli.requestTracker(payload)
+    except ConnectionError:
+        sys.exit(-1) # different exit number can be used, eg) errno library
+
+async def batchMain(args):
+    """
+    Runs every fetch and upload job concurrently, prints a JSON summary, then seeds until interrupted
+    if any job is seeding.
+    """
+    tracker = (args.tracker_ip, args.tracker_port)
+    limit = asyncio.Semaphore(args.concurrency)
+    seeding = []
+
+    # Every job shares the same limiters, so the limits hold for the whole process
+    limits = rateLimits(args)
+    upload_limiter = RateLimiter(limits['upload_rate'], limits['peer_upload_rate'])
+    download_limiter = RateLimiter(limits['download_rate'], limits['peer_download_rate'])
+
+    async def run(job, port):
+        cli = Client(args.src_ip, str(port))
+        cli.upload_limiter = upload_limiter
+        cli.download_limiter = download_limiter
+        cli.tracker_ip, cli.tracker_port = tracker
+        cli.super_seed = args.super_seed
+        async with limit:
+            try:
+                if job[0] == 'fetch':
+                    return await fetchJob(cli, job[1], args.policy, seeding)
+                return await uploadJob(cli, job[1], seeding)
+            except Exception as e:
+                # A failed job is reported like the others, it must not stop the rest of the batch
+                return {'action': job[0], 'tid' if job[0] == 'fetch' else 'file': job[1],
+                        'peer_id': cli.peer_id, 'status': 'failed', 'error': repr(e)}
+
+    jobs = [('upload', path) for path in args.upload] + [('fetch', tid) for tid in args.fetch]
+    results = await asyncio.gather(*[run(job, args.src_port + i) for i, job in enumerate(jobs)])
+
+    summary = json.dumps({'jobs': results,
+                          'failed': sum(1 for r in results if r['status'] == 'failed'),
+                          'seeding': len(seeding),
+                          'piece_cache': piece_cache.getStats()})
+    print(summary)
+    if args.summary:
+        with open(args.summary, 'w') as summary_file:
+            summary_file.write(summary + '\n')
+
+    try:
+        await asyncio.gather(*[task for cli, task in seeding])
+    finally:
+        # finished seeding, remove our seeding status from the tracker
+        for cli, task in seeding:
+            task.cancel()
+            await stopSeeding(cli)
+
+    if any(r['status'] == 'failed' for r in results):
+        sys.exit(1)
+
 async def main():
-    src_ip, src_port, dest_ip, dest_port = parseCommandLine()
+    limits = {}
+    superSeed = False
+    if any(arg.startswith('--') for arg in sys.argv[1:]):
+        args = parseBatchCommandLine()
+        profiling.install(args.trace, args.profile)
+        if args.fetch or args.upload:
+            await batchMain(args)
+            return
+        src_ip, src_port, dest_ip, dest_port = args.src_ip, str(args.src_port), args.tracker_ip, args.tracker_port
+        limits = rateLimits(args)
+        superSeed = args.super_seed
+    else:
+        profiling.install()
+        src_ip, src_port, dest_ip, dest_port = parseCommandLine()
     
     if src_ip != None and src_port != None:
-        cli = Client(src_ip, src_port)
+        cli = Client(src_ip, src_port, **limits)
+        cli.super_seed = superSeed
 
         if dest_ip == None and dest_port == None:
             # Use default IP and port
@@ -124,57 +311,39 @@ async def main():
         print("Connecting to tracker at " + dest_ip + ":" + dest_port + " ...")
         print("Connecting as client: " + src_ip + ":" + src_port + " ...")
         
+        cli.tracker_ip, cli.tracker_port = dest_ip, dest_port
         while True:
-            reader, writer = await cli.connectToTracker(dest_ip, dest_port)
-
             argList = handleUserChoice()
 
             if argList[0] > 0:
-                payload = cli.createServerRequest(opc=argList[0], torrent_id=argList[1], filename=argList[2])
+                numPieces = 0
+                if argList[0] == OPT_UPLOAD_FILE:
+                    numPieces = await cli.uploadFile(argList[2])
+                payload = cli.createServerRequest(opc=argList[0], torrent_id=argList[1], filename=argList[2], num_pieces=numPieces)
 
                 # NOTE: hacky way to handle invalid file handling (we pass an empty payload)
                 if not payload:
                     continue
 
-                # scenario 1: send a message
-                await cli.send(writer, payload)
-
-                # scenario 2: receive a message
-                result = await cli.receive(reader)
+                # Only connect once the request is ready, an idle connection would be timed out by the tracker
+                result = await cli.handleServerResponse(await requestOrExit(cli, payload))
 
                 if result == RET_FINISHED_DOWNLOAD:
-                    writer.close() # close original session, then start a new one
-                    reader, writer = await cli.connectToTracker(dest_ip, dest_port)
                     payload = cli.createServerRequest(opc=OPT_START_SEED, torrent_id=argList[1])
-                    await cli.send(writer, payload)
-                    result = await cli.receive(reader)
-                    writer.close()
+                    result = await cli.handleServerResponse(await requestOrExit(cli, payload))
                     
                 #finished seeding, send server msg to remove status as seeder
                 if result == RET_FINSH_SEEDING:   
-                    writer.close() # close original session, then start a new one
-                    reader, writer = await cli.connectToTracker(dest_ip, dest_port)
                     payload = cli.createServerRequest(opc = OPT_STOP_SEED, torrent_id=cli.tid)
-                    await cli.send(writer, payload) #send msg to tracker
-                    result = await cli.receive(reader)
-                    writer.close()
+                    await requestOrExit(cli, payload) #send msg to tracker
                     break
 
-                if result != RET_SUCCESS:
-                    writer.close()
-
-            # Help
-            elif argList[0] == 0:
-                writer.close()
-            
             # Exit
-            else:
-                writer.close()
+            elif argList[0] < 0:
                 sys.exit(0)
 
-        writer.close()
-
 if __name__ == "__main__":
+    transport.installEventLoop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,99 @@
+"""
+Optional per-piece compression. A leecher offers the codecs it can decode with each OPT_GET_RAW_PIECE
+request and the seeder picks one, sending the piece raw when it is small or doesn't compress.
+"""
+from src.protocol import *
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_NONE = 'none'
+CODEC_ZSTD = 'zstd'
+CODEC_ZLIB = 'zlib'
+CODEC_LZMA = 'lzma'
+
+# Errors the codecs raise on corrupt input
+DECODE_ERRORS = (zlib.error, EOFError) + ((lzma.LZMAError,) if lzma else ()) + ((zstandard.ZstdError,) if zstandard else ())
+
+COMPRESS_THRESHOLD = 1024       # pieces smaller than this (bytes) are always sent raw
+COMPRESS_MAX_RATIO = 0.9        # compressed output must be under 90% of the raw size to be used
+
+def availableCodecs() -> [str]:
+    """
+    Returns the codecs usable on this host, fastest first.
+    """
+    codecs = []
+    if zstandard is not None:
+        codecs.append(CODEC_ZSTD)
+    codecs.append(CODEC_ZLIB)
+    if lzma is not None:
+        codecs.append(CODEC_LZMA)
+    return codecs
+
+def chooseCodec(offered: [str]) -> str:
+    """
+    Picks our most preferred codec among the ones offered by the peer.
+    """
+    for codec in availableCodecs():
+        if codec in offered:
+            return codec
+    return CODEC_NONE
+
+def compress(codec: str, data: bytes) -> bytes:
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+    elif codec == CODEC_ZLIB:
+        return zlib.compress(data)
+    elif codec == CODEC_LZMA:
+        return lzma.compress(data)
+    return data
+
+def decompress(codec: str, data: bytes, limit: int = PIECE_SIZE) -> bytes:
+    """
+    Decompresses a piece from a peer. Output is capped, so a compression bomb can't exhaust memory:
+    raises ValueError if the data decompresses to more than limit bytes, or is corrupt or truncated.
+    """
+    try:
+        if codec == CODEC_ZSTD:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                output = reader.read(limit + 1)
+        elif codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj()
+            output = decompressor.decompress(data, limit)
+            if not decompressor.eof:
+                output += decompressor.decompress(decompressor.unconsumed_tail, 1)
+                if not decompressor.eof and len(output) <= limit:
+                    raise ValueError("truncated zlib stream")
+        elif codec == CODEC_LZMA:
+            decompressor = lzma.LZMADecompressor()
+            output = decompressor.decompress(data, max_length=limit)
+            if not decompressor.eof:
+                output += decompressor.decompress(b'', max_length=1)
+                if not decompressor.eof and len(output) <= limit:
+                    raise ValueError("truncated lzma stream")
+        else:
+            output = data
+    except DECODE_ERRORS as e:
+        raise ValueError("corrupt " + codec + " data: " + str(e))
+    if len(output) > limit:
+        raise ValueError(codec + " data decompresses to more than " + str(limit) + " bytes")
+    return output
+
+def compressPiece(data: bytes, codec: str):
+    """
+    Returns the compressed piece, or None if the piece should be sent raw.
+    """
+    if codec == CODEC_NONE or len(data) < COMPRESS_THRESHOLD:
+        return None
+    compressed = compress(codec, data)
+    if len(compressed) >= len(data) * COMPRESS_MAX_RATIO:
+        return None
+    return compressed
@@ -1,27 +1,194 @@
 from src.protocol import *
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import base64
+import hashlib
+import json
+import os
 
 ENCODING = 'utf-8'
 
-def encodeToBytes(file_name:str):
+# Disk reads/writes and base64 work run on this bounded pool, off the event loop
+IO_WORKERS = 4
+WRITE_BATCH = 64        # pieces decoded and written per write() call
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='p2py-io')
+
+# DIRECTORY TORRENTS
+# A directory is shared as one torrent. Its manifest lists every file as [path, length, offset], the path
+# relative to the directory with '/' separators and offset the file's start in the concatenation of all
+# files in manifest order. Pieces are cut from that concatenation, so a piece may span several files.
+
+def buildManifest(dir_name:str) -> list:
+    """
+    Returns the manifest of every file under dir_name, in sorted path order.
+    """
+    manifest = []
+    offset = 0
+    for root, dirs, files in os.walk(dir_name):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            length = os.path.getsize(path)
+            manifest.append([os.path.relpath(path, dir_name).replace(os.sep, '/'), length, offset])
+            offset += length
+    return manifest
+
+def checkManifest(manifest:list, num_pieces:int):
+    """
+    Raises ValueError unless every entry is a [path, length, offset] list, every path stays inside the
+    output directory, the files are contiguous and they add up to exactly num_pieces pieces.
+    """
+    if not isinstance(manifest, list):
+        raise ValueError("manifest is not a list")
+    offset = 0
+    for entry in manifest:
+        if not isinstance(entry, list) or len(entry) != 3 or not isinstance(entry[0], str) or \
+                any(type(field) is not int for field in entry[1:]):
+            raise ValueError("malformed manifest entry: " + repr(entry))
+        path, length, start = entry
+        parts = path.split('/')
+        if not path or path.startswith('/') or '..' in parts or '' in parts or '\\' in path:
+            raise ValueError("unsafe path in manifest: " + repr(path))
+        if start != offset or length < 0:
+            raise ValueError("manifest files are not contiguous at " + repr(path))
+        offset += length
+    if -(-offset // PIECE_SIZE) != num_pieces:
+        raise ValueError("manifest covers " + str(offset) + " bytes, not " + str(num_pieces) + " pieces")
+
+def totalLength(manifest:list) -> int:
+    return manifest[-1][2] + manifest[-1][1] if manifest else 0
+
+def pieceSegments(manifest:list, idx:int) -> [tuple]:
+    """
+    Returns the (path, offset in file, length) parts of piece idx, in order.
+    """
+    start = idx * PIECE_SIZE
+    end = min(start + PIECE_SIZE, totalLength(manifest))
+    segments = []
+    for path, length, offset in manifest:
+        if offset + length <= start or length == 0:
+            continue
+        if offset >= end:
+            break
+        segStart = max(start, offset)
+        segments.append((path, segStart - offset, min(end, offset + length) - segStart))
+    return segments
+
+def iterPieces(file_name:str, manifest:list=None):
+    """
+    Yields the raw pieces of a file, or of a directory's files concatenated in manifest order.
+    """
+    if manifest is None:
+        with open(file_name, "rb") as input_file:
+            piece = input_file.read(PIECE_SIZE)
+            while piece:
+                yield piece
+                piece = input_file.read(PIECE_SIZE)
+        return
+
+    piece = b''
+    for path, length, offset in manifest:
+        with open(os.path.join(file_name, path), "rb") as input_file:
+            data = input_file.read(PIECE_SIZE - len(piece))
+            while data:
+                piece += data
+                if len(piece) == PIECE_SIZE:
+                    yield piece
+                    piece = b''
+                data = input_file.read(PIECE_SIZE - len(piece))
+    if piece:
+        yield piece
+
+def encodeToBytes(file_name:str, manifest:list=None):
     pieces = []
     numPieces = 0
-    with open(file_name, "rb") as input_file:
-        piece = input_file.read(PIECE_SIZE)
-        while piece:
-            numPieces+=1
-            encodedPiece = base64.b64encode(piece)
-            hexPiece = encodedPiece.decode(ENCODING)
-            pieces.append(hexPiece)
-            piece = input_file.read(PIECE_SIZE)
+    for piece in iterPieces(file_name, manifest):
+        numPieces+=1
+        encodedPiece = base64.b64encode(piece)
+        hexPiece = encodedPiece.decode(ENCODING)
+        pieces.append(hexPiece)
     return pieces, numPieces
 
-def decodeToFile(pieces:[], output_name:str):
-    with open(output_name, "wb") as output_file:
-        for block in pieces:
-            encodedBlock = block.encode(ENCODING)
-            decodedBlock = base64.b64decode(encodedBlock)
-            output_file.write(decodedBlock)
+def decodeToFile(pieces:[], output_name:str, manifest:list=None):
+    if manifest is None:
+        with open(output_name, "wb") as output_file:
+            for start in range(0, len(pieces), WRITE_BATCH):
+                batch = pieces[start:start + WRITE_BATCH]
+                output_file.write(b''.join(base64.b64decode(block.encode(ENCODING)) for block in batch))
+        return
+
+    # Every file is written from the pieces covering its range of the piece space
+    checkManifest(manifest, len(pieces))
+    for path, length, offset in manifest:
+        target = os.path.join(output_name, *path.split('/'))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as output_file:
+            first = offset // PIECE_SIZE
+            last = (offset + length - 1) // PIECE_SIZE
+            for start in range(first, last + 1, WRITE_BATCH):
+                batch = pieces[start:min(start + WRITE_BATCH, last + 1)]
+                data = b''.join(base64.b64decode(block.encode(ENCODING)) for block in batch)
+                skip = max(offset - start * PIECE_SIZE, 0)
+                end = offset + length - start * PIECE_SIZE
+                output_file.write(data[skip:end])
+
+def hashFile(file_name:str, manifest:list=None):
+    """
+    Returns the whole-file SHA-256 hex digest and the SHA-1 digest of every piece.
+    A directory's content hash also covers its manifest, so only identical trees are deduplicated.
+    """
+    contentHash = hashlib.sha256()
+    pieceHashes = []
+    for piece in iterPieces(file_name, manifest):
+        contentHash.update(piece)
+        pieceHashes.append(hashlib.sha1(piece).digest())
+    if manifest is not None:
+        contentHash.update(json.dumps(manifest).encode())
+    return contentHash.hexdigest(), pieceHashes
+
+def packHashes(pieceHashes:[bytes]) -> str:
+    return base64.b64encode(b''.join(pieceHashes)).decode(ENCODING)
+
+def unpackHashes(packed:str) -> [bytes]:
+    raw = base64.b64decode(packed)
+    return [raw[start:start + 20] for start in range(0, len(raw), 20)]
+
+async def hashFileAsync(file_name:str, manifest:list=None):
+    """
+    hashFile() on the I/O pool.
+    """
+    return await asyncio.get_event_loop().run_in_executor(_io_pool, hashFile, file_name, manifest)
+
+def readPiece(file_name:str, idx:int, manifest:list=None) -> bytes:
+    if manifest is None:
+        with open(file_name, "rb") as input_file:
+            input_file.seek(idx * PIECE_SIZE)
+            return input_file.read(PIECE_SIZE)
+
+    data = b''
+    for path, offset, length in pieceSegments(manifest, idx):
+        with open(os.path.join(file_name, path), "rb") as input_file:
+            input_file.seek(offset)
+            data += input_file.read(length)
+    return data
+
+async def readPieceAsync(file_name:str, idx:int, manifest:list=None) -> bytes:
+    """
+    readPiece() on the I/O pool.
+    """
+    return await asyncio.get_event_loop().run_in_executor(_io_pool, readPiece, file_name, idx, manifest)
+
+async def encodeToBytesAsync(file_name:str, manifest:list=None):
+    """
+    encodeToBytes() on the I/O pool, so the event loop keeps serving other connections.
+    """
+    return await asyncio.get_event_loop().run_in_executor(_io_pool, encodeToBytes, file_name, manifest)
+
+async def decodeToFileAsync(pieces:[], output_name:str, manifest:list=None):
+    """
+    decodeToFile() on the I/O pool, so the event loop keeps serving other connections.
+    """
+    await asyncio.get_event_loop().run_in_executor(_io_pool, decodeToFile, pieces, output_name, manifest)
 
 
 # TESTING:
@@ -0,0 +1,46 @@
+"""
+Reading whole JSON messages off a stream. Every message is one line of JSON terminated by a newline,
+like the headers of raw piece transfers. A message ends at the newline, or where the peer closes the
+connection, so it is decoded exactly once however many TCP reads it arrived over.
+"""
+from src.protocol import *
+import asyncio
+import json
+
+async def readMessage(reader, limit=MAX_MESSAGE_SIZE, span=None) -> dict:
+    """
+    Reads one JSON message. Raises ValueError if the message is malformed, exceeds limit bytes,
+    or the peer closes the connection before sending a complete message.
+    A profiling span is charged the wait for the first data as queue time, the rest as decode time.
+    """
+    parts = []
+    size = 0
+    done = False
+    while not done:
+        try:
+            part = await reader.readuntil(b'\n')
+            done = True
+        except asyncio.LimitOverrunError as e:
+            # The line is longer than the stream buffer, take what is buffered and keep going
+            part = await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError as e:
+            # The peer closed the connection, whatever it sent is the whole message
+            part = e.partial
+            done = True
+        if span is not None:
+            span.mark('decode' if parts else 'queue')
+        parts.append(part)
+        size += len(part)
+        if size > limit:
+            raise ValueError("message exceeds " + str(limit) + " bytes")
+
+    data = b''.join(parts)
+    if not data.strip():
+        raise ValueError("connection closed before a message was sent")
+    try:
+        message = json.loads(data)
+    except ValueError:
+        raise ValueError("malformed or incomplete message")
+    if span is not None:
+        span.mark('decode')
+    return message
@@ -0,0 +1,80 @@
+"""
+Compact peer-list encoding for tracker responses. Each peer is its packed address: a 4 byte IPv4
+(or 16 byte IPv6) address followed by a 2 byte big-endian port, so 6 (or 18) bytes per peer.
+IPv4 and IPv6 peers go in separate lists, each base64 encoded to fit in the JSON payload.
+Peer ids aren't sent, a client derives them from the address (see Client.createPeerIDFor).
+"""
+import base64
+import random
+import socket
+import struct
+
+def packPeer(ip: str, port) -> bytes:
+    """
+    Returns the packed address of a peer, or None if ip isn't a numeric IPv4/IPv6 address.
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, ip) + struct.pack('!H', int(port))
+        except (OSError, ValueError):
+            continue
+    return None
+
+def unpackPeer(entry: bytes) -> tuple:
+    """
+    Returns the (ip, port) pair of a packed address, the port as a string.
+    """
+    family = socket.AF_INET if len(entry) == 6 else socket.AF_INET6
+    return socket.inet_ntop(family, entry[:-2]), str(struct.unpack('!H', entry[-2:])[0])
+
+def packPeerID(pid: str):
+    """
+    Returns the 16 byte digest of an MD5 hex peer id (see Client.createPeerIDFor), other ids unchanged.
+    """
+    if len(pid) == 32:
+        try:
+            digest = bytes.fromhex(pid)
+            if digest.hex() == pid:
+                return digest
+        except ValueError:
+            pass
+    return pid
+
+def unpackPeerID(pid) -> str:
+    return pid.hex() if isinstance(pid, bytes) else pid
+
+def encodePacked(entries, numwant=None):
+    """
+    Joins packed addresses into (ipv4 list, ipv6 list) base64 strings.
+    If numwant is given, at most numwant peers are included, picked at random.
+    """
+    entries = list(entries)
+    if numwant is not None and len(entries) > numwant:
+        entries = random.sample(entries, max(numwant, 0))
+
+    packed4 = b''.join(entry for entry in entries if len(entry) == 6)
+    packed6 = b''.join(entry for entry in entries if len(entry) == 18)
+    return base64.b64encode(packed4).decode(), base64.b64encode(packed6).decode()
+
+def packPeers(peers, numwant=None):
+    """
+    Packs (ip, port) pairs into (ipv4 list, ipv6 list) base64 strings.
+    If numwant is given, at most numwant peers are packed, picked at random.
+    """
+    peers = list(peers)
+    if numwant is not None and len(peers) > numwant:
+        peers = random.sample(peers, max(numwant, 0))
+    return encodePacked(entry for entry in (packPeer(ip, port) for ip, port in peers) if entry is not None)
+
+def unpackPeers(packed4: str, packed6: str = '') -> [tuple]:
+    """
+    Returns the (ip, port) pairs of packed peer lists, ports as strings like the rest of the protocol.
+    """
+    peers = []
+    for packed, family, size in ((packed4, socket.AF_INET, 4), (packed6, socket.AF_INET6, 16)):
+        raw = base64.b64decode(packed)
+        for start in range(0, len(raw), size + 2):
+            ip = socket.inet_ntop(family, raw[start:start + size])
+            port = struct.unpack('!H', raw[start + size:start + size + 2])[0]
+            peers.append((ip, str(port)))
+    return peers
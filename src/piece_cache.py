@@ -0,0 +1,72 @@
+"""
+Bounded cache of ready-to-send pieces, so the pieces of a hot swarm are served from memory instead of
+being read and compressed again for every request. It is shared by every Client of the process and keyed
+by piece digest, so a piece seeded under several torrents is only cached once.
+"""
+from src.protocol import *
+from collections import OrderedDict
+
+class PieceCache:
+    def __init__(self, max_bytes: int = PIECE_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.frames = OrderedDict()     # key -> (codec, piece bytes), least recently used first
+        self.seen = OrderedDict()       # keys refused once, admitted the next time they miss
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def setLimit(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.evict(0)
+
+    def get(self, key):
+        """
+        Returns the cached (codec, piece bytes) for key, or None.
+        """
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.frames.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def admits(self, key, length: int) -> bool:
+        """
+        Whether a missed piece of length bytes should be cached. While there is room everything is,
+        once full only pieces that missed before are, so one-off requests can't flush the hot pieces.
+        """
+        if length > self.max_bytes:
+            return False
+        if self.size + length <= self.max_bytes or key in self.seen:
+            return True
+        self.seen[key] = True
+        if len(self.seen) > max(len(self.frames), 1) * 4:
+            self.seen.popitem(last=False)
+        return False
+
+    def put(self, key, codec: str, data: bytes):
+        if key in self.frames:
+            return
+        self.seen.pop(key, None)
+        self.evict(len(data))
+        self.frames[key] = (codec, data)
+        self.size += len(data)
+
+    def evict(self, length: int):
+        """
+        Drops least recently used pieces until length more bytes fit.
+        """
+        while self.frames and self.size + length > self.max_bytes:
+            _, (_, data) = self.frames.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def getStats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'pieces': len(self.frames), 'bytes': self.size, 'max_bytes': self.max_bytes}
+
+piece_cache = PieceCache()
@@ -0,0 +1,36 @@
+"""
+Content-addressed index of pieces on disk. It is shared by every Client of the process, so a piece
+already downloaded or seeded under any torrent is read back from disk instead of fetched again.
+"""
+import src.file_handler as fd
+import hashlib
+
+class PieceStore:
+    def __init__(self):
+        self.locations = dict()         # piece sha1 digest -> (file path, piece index, directory manifest)
+
+    def addFile(self, path: str, digests: [bytes], manifest: list = None):
+        """
+        Indexes every piece of a complete file, or directory with its manifest, given its piece digests in order.
+        """
+        for idx, digest in enumerate(digests):
+            self.locations.setdefault(digest, (path, idx, manifest))
+
+    async def read(self, digest: bytes):
+        """
+        Returns the piece with the given digest, or None if it isn't stored. Pieces whose file changed
+        or disappeared since they were indexed are forgotten.
+        """
+        if digest not in self.locations:
+            return None
+        path, idx, manifest = self.locations[digest]
+        try:
+            data = await fd.readPieceAsync(path, idx, manifest)
+        except OSError:
+            data = None
+        if data is None or hashlib.sha1(data).digest() != digest:
+            del self.locations[digest]
+            return None
+        return data
+
+piece_store = PieceStore()
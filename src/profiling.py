@@ -0,0 +1,150 @@
+"""
+Opt-in diagnostics that can be turned on in a running tracker or client, without restarting it.
+
+* Request tracing: every request handled is written as one JSON line to a trace file, with the time spent
+  in each stage: queue (waiting for the request to arrive), decode, handle, encode and write.
+* SIGUSR1: profiles the process with cProfile for PROFILE_WINDOW seconds, then writes the stats to a
+  .prof file and prints the costliest functions. Sending it again during a window ends it early.
+* SIGUSR2: takes a tracemalloc snapshot and prints the allocation sites that grew the most since the
+  previous one, which is how growth in e.g. PieceBuffer shows up. The first signal starts tracemalloc.
+
+Tracing and a profiling window from startup can also be enabled with P2PY_TRACE=FILE and P2PY_PROFILE=SECONDS.
+"""
+import asyncio
+import cProfile
+import io
+import json
+import os
+import pstats
+import signal
+import time
+import tracemalloc
+
+PROFILE_WINDOW = 30         # seconds profiled per SIGUSR1
+PROFILE_TOP = 20            # functions printed after a profiling window
+MEMORY_TOP = 10             # allocation sites printed per tracemalloc snapshot
+
+_trace_file = None
+_profile = None
+_profile_timer = None
+_snapshot = None
+
+class Span:
+    """
+    Times the stages of handling one request. mark(stage) adds the time since the previous mark to stage.
+    """
+    def __init__(self, role: str, peer=None):
+        self.role = role
+        self.peer = peer
+        self.opc = None
+        self.start = self.last = time.perf_counter()
+        self.stages = dict()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def finish(self, status: str = 'ok'):
+        """
+        Writes the span to the trace file, if tracing is enabled.
+        """
+        if _trace_file is None:
+            return
+        record = {'ts': round(time.time(), 3), 'role': self.role, 'opc': self.opc,
+                  'peer': list(self.peer) if self.peer else None, 'status': status,
+                  'total_ms': round((time.perf_counter() - self.start) * 1000, 3)}
+        for stage, seconds in self.stages.items():
+            record[stage + '_ms'] = round(seconds * 1000, 3)
+        _trace_file.write(json.dumps(record) + '\n')
+
+def enableTracing(path: str):
+    global _trace_file
+    disableTracing()
+    _trace_file = open(path, 'a', buffering=1)
+    print("[PROFILE] Tracing requests to", path)
+
+def disableTracing():
+    global _trace_file
+    if _trace_file is not None:
+        _trace_file.close()
+        _trace_file = None
+
+def startProfiling(window: float = PROFILE_WINDOW):
+    """
+    Profiles the event loop thread for window seconds. Must be called from the event loop.
+    """
+    global _profile, _profile_timer
+    if _profile is not None:
+        return
+    _profile = cProfile.Profile()
+    _profile.enable()
+    _profile_timer = asyncio.get_event_loop().call_later(window, stopProfiling)
+    print(f"[PROFILE] Profiling for {window} seconds.")
+
+def stopProfiling() -> str:
+    """
+    Ends the profiling window, writes its stats to a .prof file and returns the file name.
+    """
+    global _profile, _profile_timer
+    if _profile is None:
+        return None
+    _profile.disable()
+    if _profile_timer is not None:
+        _profile_timer.cancel()
+    path = f'p2py-{os.getpid()}-{int(time.time())}.prof'
+    _profile.dump_stats(path)
+
+    out = io.StringIO()
+    pstats.Stats(_profile, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    print(out.getvalue())
+    print("[PROFILE] Profile written to", path)
+    _profile = _profile_timer = None
+    return path
+
+def toggleProfiling():
+    if _profile is None:
+        startProfiling()
+    else:
+        stopProfiling()
+
+def snapshotMemory():
+    """
+    Prints the allocation sites that grew the most since the previous snapshot.
+    """
+    global _snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        print("[PROFILE] Tracing memory allocations, signal again for a snapshot.")
+        return
+    snapshot = tracemalloc.take_snapshot()
+    if _snapshot is None:
+        stats = snapshot.statistics('lineno')
+    else:
+        stats = snapshot.compare_to(_snapshot, 'lineno')
+    current, peak = tracemalloc.get_traced_memory()
+    print(f"[PROFILE] Traced memory: {current >> 10}KB, peak {peak >> 10}KB")
+    for stat in stats[:MEMORY_TOP]:
+        print("[PROFILE]", stat)
+    _snapshot = snapshot
+
+def install(trace_path: str = None, profile_window: float = None):
+    """
+    Enables tracing and profiling from the arguments or the environment, and hooks SIGUSR1/SIGUSR2.
+    Must be called from the running event loop. Signals are skipped on platforms without them.
+    """
+    trace_path = trace_path or os.environ.get('P2PY_TRACE')
+    profile_window = profile_window or float(os.environ.get('P2PY_PROFILE', 0))
+    if trace_path:
+        enableTracing(trace_path)
+    if profile_window:
+        startProfiling(profile_window)
+
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    loop = asyncio.get_event_loop()
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, toggleProfiling)
+        loop.add_signal_handler(signal.SIGUSR2, snapshotMemory)
+    except (NotImplementedError, RuntimeError):
+        pass
@@ -6,6 +6,7 @@ OPT_GET_TORRENT = 11
 OPT_START_SEED = 12
 OPT_STOP_SEED = 13
 OPT_UPLOAD_FILE = 14
+OPT_RETRY_LATER = 15    # tracker -> peer only: the request was refused before being handled
 
 RET_FINSH_SEEDING = 2
 RET_FINISHED_DOWNLOAD = 1
@@ -14,6 +15,8 @@ RET_FAIL = -1
 RET_ALREADY_SEEDING = -2
 RET_NO_AVAILABLE_TORRENTS = -3
 RET_TORRENT_DOES_NOT_EXIST = -4
+RET_RETRY_LATER = -5
+RET_CHOKED = -6                 # peer -> peer: a super-seeder has nothing for this peer right now
 
 # PEER 2 PEER
 OPT_STATUS_INTERESTED = 1
@@ -22,6 +25,7 @@ OPT_STATUS_CHOKED = 3
 OPT_STATUS_UNCHOKED = 4
 OPT_GET_PEERS = 5
 OPT_GET_PIECE = 6
+OPT_GET_RAW_PIECE = 7   # response is a one-line JSON header followed by PIECE_LEN raw bytes
 
 # PAYLOAD FIELD NAMES
 OPC = 'OPC'
@@ -36,10 +40,58 @@ TORRENT_LIST = 'TORRENT_LIST'
 TORRENT = 'TORRENT_OBJ'
 PIECE_IDX = 'PIECE_IDX'
 PIECE_DATA = 'PIECE_DATA'
+PIECE_LEN = 'PIECE_LEN'
+CODECS = 'CODECS'
+CODEC = 'CODEC'
 PEER_LIST = 'PEER_LIST'
 SEEDER_LIST = 'SEEDER_LIST'
 LEECHER_LIST = 'LEECHER_LIST'
+PEERS_ADDED = 'PEERS_ADDED'
+PEERS_DROPPED = 'PEERS_DROPPED'
+CONTENT_HASH = 'CONTENT_HASH'
+PIECE_HASHES = 'PIECE_HASHES'
+FILE_ALIASES = 'FILE_ALIASES'
+MANIFEST = 'MANIFEST'
+RETRY_AFTER = 'RETRY_AFTER'
+HAVE_BITFIELD = 'HAVE_BITFIELD'
+SUPER_SEEDING = 'SUPER_SEEDING'
+COMPACT = 'COMPACT'
+NUMWANT = 'NUMWANT'
+COMPACT_SEEDERS = 'SEEDERS_COMPACT'
+COMPACT_SEEDERS6 = 'SEEDERS6_COMPACT'
+COMPACT_LEECHERS = 'LEECHERS_COMPACT'
+COMPACT_LEECHERS6 = 'LEECHERS6_COMPACT'
+
+# PEER EXCHANGE - seconds between gossip rounds while seeding
+PEX_INTERVAL = 30
+PEX_TIMEOUT = 5                 # seconds a peer has to answer an exchange before it is dropped
+PEX_MAX_PEERS = 20              # most peers gossiped with per round
+
+# Most peers a client asks the tracker for, per peer list
+DEFAULT_NUMWANT = 50
+
+# Passes over the missing pieces without any progress before a download is given up,
+# and the seconds waited after such a pass
+DOWNLOAD_ROUNDS = 3
+DOWNLOAD_BACKOFF = 1
+
+# Seconds after which a super-seeder hands a peer a new piece even if its last one hasn't spread.
+# Leechers choked by a super-seeder keep waiting at least this long before counting passes as stalled.
+SUPER_SEED_RELEASE = 30
+# Seconds after which a super-seeder forgets the bitfield of a peer that stopped requesting pieces.
+SUPER_SEED_PEER_EXPIRY = 120
 
 # SIZE CONSTANTS - (24KB / 16KB)
 READ_SIZE = 24576
-PIECE_SIZE = 16384
\ No newline at end of file
+PIECE_SIZE = 16384
+MAX_MESSAGE_SIZE = 4194304      # largest JSON message accepted from a peer or the tracker (4MB)
+PIECE_CACHE_SIZE = 67108864     # memory for ready-to-send pieces, shared by every torrent seeded (64MB)
+
+# TRACKER ADMISSION CONTROL
+MAX_CONNECTIONS = 512           # requests handled at once, further connections are refused
+PEER_REQUEST_RATE = 5           # requests per second allowed from one IP address...
+PEER_REQUEST_BURST = 20         # ...with bursts of up to this many
+READ_TIMEOUT = 10               # seconds a client has to send its whole request
+WRITE_TIMEOUT = 10              # seconds a client has to accept the whole response
+REJECT_TIMEOUT = 1              # seconds spent on a refused connection
+TRACKER_RETRIES = 5             # times a client retries a request the tracker refused
\ No newline at end of file
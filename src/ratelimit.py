@@ -0,0 +1,87 @@
+"""
+Token bucket bandwidth limiting for piece transfers. A RateLimiter combines one global bucket with a
+bucket per peer, so a single fast peer can't take the whole allowance of the client.
+"""
+import asyncio
+import time
+
+PEER_BUCKETS = 256          # peer buckets kept before idle ones are forgotten
+
+class TokenBucket:
+    """
+    Allows rate bytes per second on average, with bursts of up to burst bytes.
+    Waiters are served in arrival order, which keeps the allowance fair across connections.
+    """
+    def __init__(self, rate: int, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def tryConsume(self, amount: int = 1) -> bool:
+        """
+        Takes amount tokens if they are available right now, without waiting.
+        """
+        self.refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def timeUntil(self, amount: int = 1) -> float:
+        """
+        Seconds until amount tokens will be available.
+        """
+        self.refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    async def consume(self, amount: int):
+        """
+        Waits until amount bytes may be transferred. Amounts above the burst size are taken in steps.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while amount > 0:
+                step = min(amount, self.burst)
+                self.refill()
+                while self.tokens < step:
+                    await asyncio.sleep((step - self.tokens) / self.rate)
+                    self.refill()
+                self.tokens -= step
+                amount -= step
+
+class RateLimiter:
+    """
+    Global and per-peer limits in bytes per second, None for unlimited.
+    """
+    def __init__(self, rate=None, peer_rate=None):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.peer_rate = peer_rate
+        self.peers = dict()
+        self.maxPeers = PEER_BUCKETS
+
+    async def throttle(self, peer_id: str, amount: int):
+        # Wait on the peer's own bucket first so a throttled peer doesn't hold up the global queue
+        if self.peer_rate:
+            if peer_id not in self.peers:
+                if len(self.peers) >= self.maxPeers:
+                    self.prunePeers()
+                self.peers[peer_id] = TokenBucket(self.peer_rate)
+            await self.peers[peer_id].consume(amount)
+        if self.bucket is not None:
+            await self.bucket.consume(amount)
+
+    def prunePeers(self):
+        """
+        Forgets peers that have been idle long enough to have a full bucket again, they would start
+        over with a full bucket anyway. The limit doubles while most peers are active.
+        """
+        self.peers = {peer: bucket for peer, bucket in self.peers.items() if bucket.timeUntil(bucket.burst) > 0}
+        self.maxPeers = max(PEER_BUCKETS, 2 * len(self.peers))
@@ -0,0 +1,48 @@
+"""
+Tracker memory benchmark. Registers synthetic peers in one torrent and reports the bytes allocated per peer,
+for the compact peer tables and for the previous model of a dict per peer keyed by its MD5 hex id:
+
+    python -m src.test.bench_tracker_memory                 # 1M peers
+    python -m src.test.bench_tracker_memory --peers 100000
+"""
+from src.torrent import *
+import argparse
+import hashlib
+import tracemalloc
+
+def peerAddresses(count: int):
+    for n in range(count):
+        ip = f'10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255}'
+        port = str(6881 + n % 1000)
+        yield hashlib.md5((ip + port).encode()).hexdigest(), ip, port
+
+def measure(count: int, compact: bool) -> int:
+    """
+    Returns the bytes still allocated after registering count seeders.
+    """
+    tracemalloc.start()
+    if compact:
+        torrent = Torrent(0, 'bench.bin', 1)
+        for pid, ip, port in peerAddresses(count):
+            torrent.addSeeder(pid, ip, port)
+    else:
+        torrent = dict()
+        for pid, ip, port in peerAddresses(count):
+            torrent[pid] = {IP: ip, PORT: port}
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return allocated
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--peers', type=int, default=1000000)
+    args = parser.parse_args()
+
+    before = measure(args.peers, compact=False)
+    after = measure(args.peers, compact=True)
+    print(f'{args.peers} peers')
+    print(f'dict per peer: {before / args.peers:.1f} bytes/peer ({before >> 20}MB)')
+    print(f'peer table:    {after / args.peers:.1f} bytes/peer ({after >> 20}MB)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Loopback piece-transfer benchmark. Seeds a synthetic file from one client and downloads it with another,
+reporting throughput. Compare transport profiles with:
+
+    python -m src.test.bench_transfer                # tuned sockets, uvloop if installed and P2PY_UVLOOP=1
+    python -m src.test.bench_transfer --untuned      # default socket options and event loop
+"""
+from src.client import *
+import src.transport as transport
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+async def transfer(path: str, rounds: int) -> float:
+    seeder = Client('127.0.0.1', '9881')
+    await seeder.uploadFile(path)
+    server = await transport.startServer(seeder.receiveRequest, '127.0.0.1', 9881, data=True)
+
+    leecher = Client('127.0.0.1', '9882')
+    leecher.codecs = []             # random data doesn't compress, measure the raw path only
+    leecher.seeders_list = {seeder.peer_id: {IP: '127.0.0.1', PORT: '9881'}}
+    numPieces = seeder.piece_buffer.getSize()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        leecher.piece_buffer.setBuffer(numPieces)
+        await leecher.evenPeerSelection(leecher.piece_buffer.getMissingPieces())
+    elapsed = time.perf_counter() - start
+
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=8, help='file size in MB')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--untuned', action='store_true')
+    args = parser.parse_args()
+
+    transport.TUNING_ENABLED = not args.untuned
+    usingUvloop = False if args.untuned else transport.installEventLoop()
+
+    with tempfile.NamedTemporaryFile() as seed_file:
+        seed_file.write(os.urandom(args.size * 1024 * 1024))
+        seed_file.flush()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            elapsed = asyncio.run(transfer(seed_file.name, args.rounds))
+
+    megabytes = args.size * args.rounds
+    print(f"tuned={not args.untuned} uvloop={usingUvloop} {megabytes} MB in {elapsed:.2f}s -> {megabytes / elapsed:.1f} MB/s")
+
+if __name__ == "__main__":
+    main()
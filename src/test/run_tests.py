@@ -1,6 +1,16 @@
 from src.client import *
 from src.Tracker import *
 from src.protocol import *
+from src.piece_cache import PieceCache
+from src.ratelimit import PEER_BUCKETS
+import time
+import pytest
+import json
+import src.profiling as profiling
+import src.Tracker
+import src.client
+import src.client_handler as client_handler
+import argparse
 
 def test_createServerRequest():
     ip = '127.0.0.2'
@@ -14,7 +24,9 @@ def test_createServerRequest():
         IP:ip,
         PORT:port,
         PID:peer_id,
-        TID:tid
+        TID:tid,
+        COMPACT:1,
+        NUMWANT:DEFAULT_NUMWANT
     }
     actualPayload = cli.createServerRequest(opc=opc, torrent_id=tid)
     assert(actualPayload == expectedPayload )
@@ -76,3 +88,514 @@ def test_handlePeerRequest():
 
 
 
+def test_peerExchangeIsIncremental():
+    seeder = Client('127.0.0.2', '8080')
+    leecher = Client('127.0.0.3', '8081')
+    seeder.tid = leecher.tid = 0
+    seeder.peer_am_seeding = True
+    seeder.seeders_list = {'other': {IP: '127.0.0.4', PORT: '8082'}}
+
+    request = leecher.createPeerRequest(OPT_GET_PEERS, peer_id=seeder.peer_id)
+    response = seeder.handlePeerRequest(request)
+    assert(leecher.handlePeerResponse(response) == 1)
+    assert(set(leecher.seeders_list) == {'other', seeder.peer_id})
+
+    # Nothing changed, so the next round carries no peers
+    request = leecher.createPeerRequest(OPT_GET_PEERS, peer_id=seeder.peer_id)
+    response = seeder.handlePeerRequest(request)
+    assert(request[PEERS_ADDED] == {} and response[PEERS_ADDED] == {})
+
+    seeder.dropPeer('other')
+    added, dropped = seeder.getPexDelta(leecher.peer_id)
+    assert(added == {} and dropped == ['other'])
+
+def test_silentPeersAreDroppedFromExchange(monkeypatch):
+    monkeypatch.setattr(src.client, 'PEX_TIMEOUT', 0.2)
+    monkeypatch.setattr(src.client, 'PEX_MAX_PEERS', 2)
+    leecher = Client('127.0.0.3', '8081')
+    leecher.tid = 0
+
+    async def silent(reader, writer):
+        await reader.read()
+
+    async def exchange():
+        server = await asyncio.start_server(silent, '127.0.0.1', 0)
+        port = str(server.sockets[0].getsockname()[1])
+        leecher.seeders_list = {str(n): {IP: '127.0.0.1', PORT: port} for n in range(3)}
+        async with server:
+            await asyncio.wait_for(leecher.exchangePeers(), 2)
+
+    # Two of the three peers are dialed this round, both time out and are dropped
+    asyncio.run(exchange())
+    assert(len(leecher.seeders_list) == 1)
+
+def test_rawPieceServedFromFile(tmp_path):
+    path = tmp_path / 'seed.bin'
+    path.write_bytes(bytes(range(256)) * 100)
+    seeder = Client('127.0.0.2', '8080', peer_upload_rate=1 << 30)
+    leecher = Client('127.0.0.3', '8081')
+    asyncio.run(seeder.uploadFile(str(path)))
+    leecher.piece_buffer.setBuffer(seeder.piece_buffer.getSize())
+
+    async def fetch(idx):
+        server = await asyncio.start_server(seeder.receiveRequest, '127.0.0.1', 0)
+        port = str(server.sockets[0].getsockname()[1])
+        async with server:
+            return await leecher.connectToPeer('127.0.0.1', port, leecher.createPeerRequest(OPT_GET_RAW_PIECE, idx))
+
+    assert(asyncio.run(fetch(1)) == 1)
+    assert(base64.b64decode(leecher.piece_buffer.getData(1)) == path.read_bytes()[PIECE_SIZE:])
+    assert(asyncio.run(fetch(5)) == -1)
+    # Uploads are limited per connecting address, not per the address the leecher claims
+    assert(list(seeder.upload_limiter.peers) == ['127.0.0.1'])
+
+    # The seeder keeps no piece bytes in memory, legacy piece requests are answered from the file too
+    assert(seeder.piece_buffer.getData(1) == -1 and seeder.piece_buffer.checkIfHaveAllPieces())
+    response = seeder.handlePeerRequest(leecher.createPeerRequest(OPT_GET_PIECE, 1))
+    assert(response[PIECE_DATA] == leecher.piece_buffer.getData(1))
+
+def test_pieceBufferBitset():
+    buffer = PieceBuffer()
+    buffer.setBuffer(20)
+    for idx in range(0, 20, 2):
+        buffer.addData(Piece(idx, 'data'))
+    buffer.addData(Piece(0, 'data'))
+    assert(buffer.getHaveCount() == 10)
+    assert(buffer.getMissingPieces() == list(range(1, 20, 2)))
+    assert(not buffer.checkIfHavePiece(20))
+
+    for idx in range(1, 20, 2):
+        assert(not buffer.checkIfHaveAllPieces())
+        buffer.addData(Piece(idx, 'data'))
+    assert(buffer.checkIfHaveAllPieces())
+
+def test_fileRoundTripOffLoop(tmp_path):
+    source = tmp_path / 'in.bin'
+    source.write_bytes(os.urandom(PIECE_SIZE * 3 + 7))
+
+    async def roundTrip():
+        pieces, numPieces = await fd.encodeToBytesAsync(str(source))
+        await fd.decodeToFileAsync(pieces, str(tmp_path / 'out.bin'))
+        return numPieces
+
+    assert(asyncio.run(roundTrip()) == 4)
+    assert((tmp_path / 'out.bin').read_bytes() == source.read_bytes())
+
+def test_pieceCompressionNegotiation():
+    text = b'timestamp,level,message\n' * 600
+    assert(compression.chooseCodec(['zlib']) == compression.CODEC_ZLIB)
+    assert(compression.chooseCodec([]) == compression.CODEC_NONE)
+    compressed = compression.compressPiece(text, compression.CODEC_ZLIB)
+    assert(compression.decompress(compression.CODEC_ZLIB, compressed) == text)
+    assert(compression.compressPiece(os.urandom(PIECE_SIZE), compression.CODEC_ZLIB) is None)
+    assert(compression.compressPiece(text[:100], compression.CODEC_ZLIB) is None)
+
+    # Peers can't make us inflate more than a piece
+    bomb = compression.compress(compression.CODEC_ZLIB, bytes(PIECE_SIZE * 64))
+    with pytest.raises(ValueError):
+        compression.decompress(compression.CODEC_ZLIB, bomb)
+
+def test_compactPeerLists():
+    tracker = TrackerServer()
+    tracker.addNewFile({PID: 'seeder', IP: '127.0.0.2', PORT: '8080', FILE_NAME: 'a.txt', TOTAL_PIECES: 1})
+    for port in range(9000, 9010):
+        tracker.torrent[0].addSeeder(str(port), '10.0.0.1', str(port))
+    tracker.torrent[0].addSeeder('v6', '::1', '9100')
+
+    cli = Client('127.0.0.3', '8081')
+    request = cli.createServerRequest(OPT_GET_TORRENT, torrent_id=0)
+    torrent = tracker.handleRequest(request)[TORRENT]
+    assert(SEEDER_LIST not in torrent)
+    seeders = cli.getSeedersFrom(torrent)
+    assert(len(seeders) == 12)
+    assert(seeders[cli.createPeerIDFor('127.0.0.2', '8080')] == {IP: '127.0.0.2', PORT: '8080'})
+    assert(cli.createPeerIDFor('::1', '9100') in seeders)
+
+    request[NUMWANT] = 3
+    assert(len(cli.getSeedersFrom(tracker.handleRequest(request)[TORRENT])) == 3)
+
+    # Seeders registered by host name are still listed
+    tracker.torrent[0].addSeeder('named', 'localhost', '9200')
+    request[NUMWANT] = DEFAULT_NUMWANT
+    assert(cli.getSeedersFrom(tracker.handleRequest(request)[TORRENT])['named'] == {IP: 'localhost', PORT: '9200'})
+
+    # NUMWANT bounds the seeders sent, packed and named together
+    for n in range(5):
+        tracker.torrent[0].addSeeder('named' + str(n), 'host' + str(n), '9200')
+    request[NUMWANT] = 3
+    for _ in range(10):
+        assert(len(cli.getSeedersFrom(tracker.handleRequest(request)[TORRENT])) == 3)
+
+def test_tokenBucketRateLimit():
+    limiter = RateLimiter(rate=200 * 1024, peer_rate=100 * 1024)
+
+    async def transfer():
+        start = time.monotonic()
+        await asyncio.gather(limiter.throttle('a', 150 * 1024), limiter.throttle('b', 150 * 1024))
+        return time.monotonic() - start
+
+    # Each peer waits 0.5s on its own 100KB/s bucket, then the 200KB global burst only covers the first one
+    elapsed = asyncio.run(transfer())
+    assert(0.9 < elapsed < 1.5)
+
+    # Buckets of idle peers are forgotten rather than kept for every peer ever seen
+    async def manyPeers():
+        for n in range(3 * PEER_BUCKETS):
+            await limiter.throttle(str(n), 1)
+    asyncio.run(manyPeers())
+    assert(len(limiter.peers) <= PEER_BUCKETS)
+
+def test_identicalUploadsShareOneSwarm(tmp_path):
+    (tmp_path / 'a.bin').write_bytes(b'abc' * PIECE_SIZE)
+    (tmp_path / 'b.bin').write_bytes(b'abc' * PIECE_SIZE)
+    tracker = TrackerServer()
+    first = Client('127.0.0.2', '8080')
+    second = Client('127.0.0.3', '8081')
+    for cli, name in ((first, 'a.bin'), (second, 'b.bin')):
+        numPieces = asyncio.run(cli.uploadFile(str(tmp_path / name)))
+        response = tracker.handleRequest(cli.createServerRequest(OPT_UPLOAD_FILE, filename=str(tmp_path / name), num_pieces=numPieces))
+        assert(response[RET] == RET_SUCCESS and response[TID] == 0)
+
+    torrent = tracker.getTorrentDict()[0]
+    assert(len(torrent[SEEDER_LIST]) == 2)
+    assert(torrent[FILE_ALIASES] == ['a.bin', 'b.bin'])
+
+    # A leecher of the torrent finds every piece in the shared store and needs no peers
+    leecher = Client('127.0.0.4', '8082')
+    leecher.piece_hashes = fd.unpackHashes(tracker.torrent[0].piece_hashes)
+    leecher.piece_buffer.setBuffer(len(leecher.piece_hashes))
+    asyncio.run(leecher.reuseStoredPieces())
+    assert(leecher.piece_buffer.checkIfHaveAllPieces())
+
+def test_torrentIdsAreNotReused():
+    tracker = TrackerServer()
+    upload = lambda pid, name: tracker.addNewFile({PID: pid, IP: '127.0.0.2', PORT: pid, FILE_NAME: name,
+                                                   TOTAL_PIECES: 1, CONTENT_HASH: 'hash-' + name})
+    assert(upload('1', 'a') == (RET_SUCCESS, 0) and upload('2', 'b') == (RET_SUCCESS, 1))
+    tracker.updateStopSeed({TID: 0, PID: '1'})
+    assert(upload('3', 'c') == (RET_SUCCESS, 2))
+
+    # Re-uploading b still joins b's swarm
+    assert(upload('4', 'b') == (RET_SUCCESS, 1))
+    assert(tracker.torrent[1].aliases == ['b'] and tracker.torrent[2].aliases == ['c'])
+
+def test_trackerAdmissionControl():
+    tracker = TrackerServer(request_rate=1, request_burst=2)
+    request = json.dumps({OPC: OPT_GET_LIST, IP: '127.0.0.2', PORT: '8080', PID: 'test'}).encode() + b'\n'
+
+    async def ask(port, chunks):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for chunk in chunks:
+            writer.write(chunk)
+            await writer.drain()
+            await asyncio.sleep(0.05)
+        response = await framing.readMessage(reader)
+        writer.close()
+        return response
+
+    async def flood():
+        server = await asyncio.start_server(tracker.receiveRequest, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            # The first request arrives over two reads
+            return [await ask(port, [request[:10], request[10:]]), await ask(port, [request]), await ask(port, [request])]
+
+    first, second, third = asyncio.run(flood())
+    assert(first[RET] == RET_NO_AVAILABLE_TORRENTS and second[RET] == RET_NO_AVAILABLE_TORRENTS)
+    assert(third[RET] == RET_RETRY_LATER and 0 < third[RETRY_AFTER] <= 1)
+    assert(tracker.activeConnections == 0)
+
+def test_idleTrackerConnectionIsDropped(monkeypatch):
+    monkeypatch.setattr(src.Tracker, 'READ_TIMEOUT', 0.2)
+    tracker = TrackerServer()
+    cli = Client('127.0.0.1', '9894')
+
+    async def idle():
+        server = await asyncio.start_server(tracker.receiveRequest, '127.0.0.1', 0)
+        cli.tracker_ip, cli.tracker_port = '127.0.0.1', server.sockets[0].getsockname()[1]
+        async with server:
+            # A client that connects, then waits on its user, holds a connection slot until READ_TIMEOUT
+            reader, writer = await cli.connectToTracker(cli.tracker_ip, cli.tracker_port)
+            await asyncio.sleep(0.1)
+            busy = tracker.activeConnections
+            closed = await asyncio.wait_for(reader.read(), 1)
+            writer.close()
+            # Building the request first and connecting only to send it is answered
+            response = await cli.requestTracker(cli.createServerRequest(OPT_GET_LIST))
+            return busy, closed, response
+
+    busy, closed, response = asyncio.run(idle())
+    assert(busy == 1 and closed == b'' and tracker.activeConnections == 0)
+    assert(response[RET] == RET_NO_AVAILABLE_TORRENTS)
+
+def test_superSeedingHandsOutOnePieceAtATime():
+    seeder = Client('127.0.0.1', '9880')
+    seeder.piece_buffer.setBuffer(4)
+    for idx in range(4):
+        seeder.piece_buffer.addData(Piece(idx, 'data'))
+    seeder.super_seeding = True
+    seeder.resetSuperSeeding()
+
+    def bitfield(*pieces):
+        have = PieceBuffer()
+        have.setBuffer(4)
+        for idx in pieces:
+            have.addData(Piece(idx, 'data'))
+        return {PIECE_IDX: 0, HAVE_BITFIELD: base64.b64encode(have.getBitfield()).decode()}
+
+    assert(seeder.superSeedPiece('a', bitfield()) == 0)
+    assert(seeder.superSeedPiece('b', bitfield()) == 1)       # piece 0 already went to a
+    assert(seeder.superSeedPiece('b', bitfield()) == 1)       # resent until b has it
+    assert(seeder.superSeedPiece('a', bitfield(0)) is None)   # piece 0 hasn't reached b yet
+    assert(seeder.superSeedPiece('b', bitfield(0, 1)) is None) # b got piece 0 from a, but a lacks piece 1
+    assert(seeder.superSeedPiece('a', bitfield(0, 1)) == 2)   # piece 0 spread to b, a moves on
+    assert(seeder.superSeedPiece('b', bitfield(0, 1)) == 3)
+    assert(seeder.superSeedPiece('c', {PIECE_IDX: 2}) is None)  # choked until it sends its bitfield
+    seeder.dropPeer('b')                                          # b's pieces stop counting once it is gone
+    assert(seeder.super_holders == [1, 1, 0, 0] and 'b' not in seeder.peer_have)
+
+def test_pieceCacheIsBoundedAndFrequencyAware():
+    cache = PieceCache(max_bytes=3 * PIECE_SIZE)
+    piece = bytes(PIECE_SIZE)
+    for key in ('a', 'b', 'c'):
+        assert(cache.admits(key, PIECE_SIZE))
+        cache.put(key, 'none', piece)
+    assert(cache.get('a') == ('none', piece))
+
+    # A full cache refuses a piece the first time it misses, and admits it the next time
+    assert(cache.get('d') is None and not cache.admits('d', PIECE_SIZE))
+    assert(cache.get('d') is None and cache.admits('d', PIECE_SIZE))
+    cache.put('d', 'none', piece)
+    assert(cache.get('b') is None)      # least recently used piece was evicted
+    assert(cache.get('a') is not None)
+
+    stats = cache.getStats()
+    assert(stats['bytes'] == 3 * PIECE_SIZE and stats['evictions'] == 1)
+    assert((stats['hits'], stats['misses']) == (2, 3))
+
+def test_requestTracingSpans(tmp_path):
+    trace = tmp_path / 'trace.jsonl'
+    profiling.enableTracing(str(trace))
+    tracker = TrackerServer()
+
+    async def request():
+        server = await asyncio.start_server(tracker.receiveRequest, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(json.dumps({OPC: OPT_GET_LIST, IP: '127.0.0.1', PORT: '8081', PID: 'p'}).encode() + b'\n')
+            await framing.readMessage(reader)
+            writer.close()
+
+    try:
+        asyncio.run(request())
+    finally:
+        profiling.disableTracing()
+    span = json.loads(trace.read_text())
+    assert(span['role'] == 'tracker' and span['opc'] == OPT_GET_LIST and span['status'] == 'ok')
+    assert(all(stage + '_ms' in span for stage in ('queue', 'decode', 'handle', 'encode', 'write')))
+
+def test_peerTablesAreCompact():
+    cli = Client('127.0.0.1', '8081')
+    torrent = Torrent(0, 'a.txt', 1)
+    torrent.addSeeder(cli.peer_id, '127.0.0.1', '8081')
+    torrent.addSeeder('named', 'localhost', '8082')
+    torrent.addLeecher(cli.createPeerIDFor('::1', '9000'), '::1', '9000')
+
+    # Ids are stored as digests and addresses packed, but the dict view is unchanged
+    assert(bytes.fromhex(cli.peer_id) in torrent.seeders.peers)
+    assert(torrent.getSeeders() == {cli.peer_id: {IP: '127.0.0.1', PORT: '8081'}, 'named': {IP: 'localhost', PORT: '8082'}})
+    assert(torrent.hasSeeder(cli.peer_id) and not torrent.hasSeeder(cli.createPeerIDFor('::1', '9000')))
+    packed4, packed6, named = torrent.leechers.sample()
+    assert(peerlist.unpackPeers(packed4, packed6) == [('::1', '9000')] and named == {})
+
+    torrent.removeSeeder(cli.peer_id)
+    assert(len(torrent.seeders) == 1 and torrent.getSeeders() == {'named': {IP: 'localhost', PORT: '8082'}})
+
+def test_directoryTorrentPieceSpace(tmp_path):
+    source = tmp_path / 'dataset'
+    (source / 'sub').mkdir(parents=True)
+    files = {'a.bin': os.urandom(PIECE_SIZE // 2), 'sub/b.bin': os.urandom(PIECE_SIZE), 'sub/empty': b'', 'z.txt': b'tail'}
+    for path, data in files.items():
+        (source / path).write_bytes(data)
+
+    manifest = fd.buildManifest(str(source))
+    assert([entry[0] for entry in manifest] == ['a.bin', 'z.txt', 'sub/b.bin', 'sub/empty'])
+    pieces, numPieces = fd.encodeToBytes(str(source), manifest)
+    assert(numPieces == 2)
+
+    # Pieces cross file boundaries, and are read back from every file they span
+    raw = b''.join(base64.b64decode(piece) for piece in pieces)
+    assert(raw == b''.join(files[path] for path, _, _ in manifest))
+    assert(fd.readPiece(str(source), 0, manifest) == raw[:PIECE_SIZE])
+    assert(fd.pieceSegments(manifest, 0) == [('a.bin', 0, PIECE_SIZE // 2), ('z.txt', 0, 4), ('sub/b.bin', 0, PIECE_SIZE // 2 - 4)])
+
+    fd.decodeToFile(pieces, str(tmp_path / 'out'), manifest)
+    for path, data in files.items():
+        assert((tmp_path / 'out' / path).read_bytes() == data)
+
+    with pytest.raises(ValueError):
+        fd.checkManifest([['../escape', 1, 0]], 1)
+    for malformed in ({'a.bin': 1}, [['a.bin', '1', 0]], [['a.bin', 1]], ['a.bin'], [[None, 1, 0]]):
+        with pytest.raises(ValueError):
+            fd.checkManifest(malformed, 1)
+    with pytest.raises(ValueError):
+        fd.checkManifest(manifest[:-2], numPieces)      # files missing from the manifest
+
+def test_superSeedingSwarmWithTwoLeechers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'output').mkdir()
+    source = tmp_path / 'seed.bin'
+    source.write_bytes(os.urandom(PIECE_SIZE * 12 - 100))
+
+    tracker = TrackerServer()
+    seeder = Client('127.0.0.1', '9891')
+    seeder.super_seed = True
+    leechers = [Client('127.0.0.1', '9892'), Client('127.0.0.1', '9893')]
+    for cli in [seeder] + leechers:
+        cli.tracker_ip, cli.tracker_port = '127.0.0.1', '9890'
+
+    async def fetch(cli):
+        response = await cli.requestTracker(cli.createServerRequest(OPT_GET_TORRENT, torrent_id=0))
+        return await cli.handleServerResponse(response)
+
+    async def swarm():
+        server = await asyncio.start_server(tracker.receiveRequest, '127.0.0.1', 9890)
+        numPieces = await seeder.uploadFile(str(source))
+        response = await seeder.requestTracker(seeder.createServerRequest(OPT_UPLOAD_FILE, filename=str(source), num_pieces=numPieces))
+        seeding = asyncio.ensure_future(seeder.handleServerResponse(response))
+        await asyncio.sleep(0.1)
+        piece_store.locations.clear()       # the leechers must not copy the pieces from the seeder's file
+        try:
+            return await asyncio.wait_for(asyncio.gather(*[fetch(cli) for cli in leechers]), 60)
+        finally:
+            for cli in leechers:
+                await cli.stopServing()
+            seeding.cancel()
+            server.close()
+
+    start = time.monotonic()
+    assert(asyncio.run(swarm()) == [RET_FINISHED_DOWNLOAD, RET_FINISHED_DOWNLOAD])
+    for cli in leechers:
+        assert(open(cli.seed_path, 'rb').read() == source.read_bytes())
+    # Pieces spread between the leechers, rather than each waiting out SUPER_SEED_RELEASE per piece
+    assert(time.monotonic() - start < SUPER_SEED_RELEASE)
+
+def test_brokenSeederDoesNotAbortDownload():
+    leecher = Client('127.0.0.3', '8081')
+    leecher.piece_buffer.setBuffer(2)
+
+    async def fetch(response):
+        async def seeder(reader, writer):
+            await reader.read(READ_SIZE)
+            writer.write(response)
+            await writer.drain()
+            writer.close()
+        server = await asyncio.start_server(seeder, '127.0.0.1', 0)
+        port = str(server.sockets[0].getsockname()[1])
+        leecher.seeders_list = {'seeder': {IP: '127.0.0.1', PORT: port}}
+        async with server:
+            return await leecher.connectToPeer('127.0.0.1', port, leecher.createPeerRequest(OPT_GET_RAW_PIECE, 0))
+
+    header = {OPC: OPT_GET_RAW_PIECE, PIECE_IDX: 0, RET: RET_SUCCESS, PIECE_LEN: PIECE_SIZE}
+    assert(asyncio.run(fetch(json.dumps(header).encode() + b'\n' + bytes(100))) == -1)    # closed mid-piece
+    assert(asyncio.run(fetch(b'')) == -1)                                                 # no header at all
+    header[PIECE_LEN] = 1 << 40
+    assert(asyncio.run(fetch(json.dumps(header).encode() + b'\n')) == -1)                 # absurd length
+    assert(leecher.piece_buffer.getHaveCount() == 0)
+
+def test_piecesServedWithoutLoopSendfile(tmp_path, monkeypatch):
+    # Event loops like uvloop don't implement loop.sendfile()
+    async def noSendfile(*args, **kwargs):
+        raise NotImplementedError
+    monkeypatch.setattr(asyncio.BaseEventLoop, 'sendfile', noSendfile)
+    monkeypatch.setattr(piece_cache, 'max_bytes', 0)
+
+    path = tmp_path / 'seed.bin'
+    path.write_bytes(os.urandom(PIECE_SIZE * 2))
+    seeder = Client('127.0.0.2', '8080')
+    leecher = Client('127.0.0.3', '8081')
+    leecher.codecs = []
+    asyncio.run(seeder.uploadFile(str(path)))
+    leecher.piece_buffer.setBuffer(2)
+
+    async def fetch():
+        server = await asyncio.start_server(seeder.receiveRequest, '127.0.0.1', 0)
+        port = str(server.sockets[0].getsockname()[1])
+        async with server:
+            return await leecher.connectToPeer('127.0.0.1', port, leecher.createPeerRequest(OPT_GET_RAW_PIECE, 1))
+
+    assert(asyncio.run(fetch()) == 1)
+    assert(base64.b64decode(leecher.piece_buffer.getData(1)) == path.read_bytes()[PIECE_SIZE:])
+
+def test_incompressiblePiecesAreSentWithSendfile(tmp_path, monkeypatch):
+    monkeypatch.setattr(piece_cache, 'max_bytes', 0)
+    sent = []
+    sendFile = transport.sendFile
+    async def countingSendFile(writer, file, offset, count):
+        sent.append((offset, count))
+        await sendFile(writer, file, offset, count)
+    monkeypatch.setattr(transport, 'sendFile', countingSendFile)
+
+    path = tmp_path / 'seed.bin'
+    path.write_bytes(os.urandom(PIECE_SIZE * 2))
+    seeder = Client('127.0.0.2', '8080')
+    leecher = Client('127.0.0.3', '8081')       # offers its codecs, as leechers do by default
+    asyncio.run(seeder.uploadFile(str(path)))
+
+    async def fetch():
+        server = await asyncio.start_server(seeder.receiveRequest, '127.0.0.1', 0)
+        port = str(server.sockets[0].getsockname()[1])
+        async with server:
+            results = []
+            for _ in range(2):
+                leecher.piece_buffer.setBuffer(2)
+                results.append(await leecher.connectToPeer('127.0.0.1', port, leecher.createPeerRequest(OPT_GET_RAW_PIECE, 1)))
+            return results
+
+    # The first request finds the piece doesn't compress, the second skips compression and uses sendfile
+    assert(asyncio.run(fetch()) == [1, 1] and seeder.isIncompressible(1))
+    assert(sent == [(PIECE_SIZE, PIECE_SIZE)])
+    assert(base64.b64decode(leecher.piece_buffer.getData(1)) == path.read_bytes()[PIECE_SIZE:])
+
+def test_unreachableTrackerRaises():
+    cli = Client('127.0.0.3', '8081')
+    cli.tracker_ip, cli.tracker_port = '127.0.0.1', '9'
+    with pytest.raises(ConnectionError):
+        asyncio.run(cli.requestTracker(cli.createServerRequest(OPT_GET_LIST)))
+
+def test_failedBatchJobsAreReported(tmp_path, monkeypatch):
+    async def broken(self, payload):
+        raise RuntimeError('unexpected')
+    monkeypatch.setattr(Client, 'requestTracker', broken)
+
+    summary = tmp_path / 'summary.json'
+    args = argparse.Namespace(src_ip='127.0.0.1', src_port=9895, tracker_ip='127.0.0.1', tracker_port='9',
+                              fetch=[3], upload=[str(tmp_path / 'missing.bin')], policy='exit', concurrency=2,
+                              summary=str(summary), upload_limit=None, download_limit=None, peer_upload_limit=None,
+                              peer_download_limit=None, super_seed=False)
+    with pytest.raises(SystemExit):
+        asyncio.run(client_handler.batchMain(args))
+
+    # Any exception fails only its own job, which names its torrent id or file like a successful one
+    upload, fetch = json.loads(summary.read_text())['jobs']
+    assert(upload['status'] == 'failed' and upload['file'] == args.upload[0])
+    assert(fetch['status'] == 'failed' and fetch['tid'] == 3 and 'RuntimeError' in fetch['error'])
+
+def test_messagesAreNewlineFramed():
+    async def read(chunks):
+        reader = asyncio.StreamReader()
+        for chunk in chunks:
+            reader.feed_data(chunk)
+        reader.feed_eof()
+        return await framing.readMessage(reader)
+
+    # A 3MB message, longer than the stream buffer, is read in linear time and decoded once
+    big = json.dumps({PIECE_HASHES: 'x' * (3 << 20)}).encode() + b'\n'
+    start = time.perf_counter()
+    assert(len(asyncio.run(read([big[i:i + READ_SIZE] for i in range(0, len(big), READ_SIZE)]))[PIECE_HASHES]) == 3 << 20)
+    assert(time.perf_counter() - start < 0.2)
+    assert(asyncio.run(read([b'{"OPC": 1}'])) == {OPC: 1})          # a message may also end at EOF
+    for bad in ([b''], [b'{"OPC": '], [b'x' * (MAX_MESSAGE_SIZE + 1)]):
+        with pytest.raises(ValueError):
+            asyncio.run(read(bad))
@@ -1,39 +1,112 @@
 from src.protocol import *
+import src.peerlist as peerlist
+import random
+
+class PeerTable:
+    """
+    The seeders or leechers of a torrent. A tracker may hold millions of peers, so rather than a dict per
+    peer, ids are kept as 16 byte digests and addresses in their packed form (see peerlist).
+    Peers are kept in dense lists so a random sample of them costs O(numwant), not O(peers).
+    """
+    __slots__ = ('peers', 'ids', 'addresses')
+
+    def __init__(self):
+        self.peers = dict()         # packed peer id -> position in ids and addresses
+        self.ids = []               # packed peer ids
+        self.addresses = []         # packed addresses, or (ip, port) for host names
+
+    def add(self, pid: str, peer_ip, peer_port):
+        address = peerlist.packPeer(peer_ip, peer_port)
+        if address is None:
+            address = (peer_ip, peer_port)
+        key = peerlist.packPeerID(pid)
+        pos = self.peers.get(key)
+        if pos is None:
+            self.peers[key] = len(self.ids)
+            self.ids.append(key)
+            self.addresses.append(address)
+        else:
+            self.addresses[pos] = address
+
+    def remove(self, pid: str):
+        pos = self.peers.pop(peerlist.packPeerID(pid), None)
+        if pos is None:
+            return
+        # Move the last peer into the freed position so the lists stay dense
+        lastId, lastAddress = self.ids.pop(), self.addresses.pop()
+        if pos < len(self.ids):
+            self.ids[pos], self.addresses[pos] = lastId, lastAddress
+            self.peers[lastId] = pos
+
+    def __contains__(self, pid: str) -> bool:
+        return peerlist.packPeerID(pid) in self.peers
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+    def toDict(self) -> dict:
+        """
+        Returns {peer id: {IP: ip, PORT: port}}, the SEEDER_LIST / LEECHER_LIST format.
+        """
+        peers = dict()
+        for pid, address in zip(self.ids, self.addresses):
+            ip, port = address if isinstance(address, tuple) else peerlist.unpackPeer(address)
+            peers[peerlist.unpackPeerID(pid)] = {IP: ip, PORT: port}
+        return peers
+
+    def sample(self, numwant=None):
+        """
+        Returns (ipv4 list, ipv6 list, named peers) for at most numwant peers picked at random: the compact
+        lists of the packed addresses, and the peers registered with a host name, which compact lists can't
+        carry, as toDict() does.
+        """
+        positions = range(len(self.ids))
+        if numwant is not None and len(positions) > numwant:
+            positions = random.sample(positions, max(numwant, 0))
+        packed = []
+        named = dict()
+        for pos in positions:
+            address = self.addresses[pos]
+            if isinstance(address, tuple):
+                named[peerlist.unpackPeerID(self.ids[pos])] = {IP: address[0], PORT: address[1]}
+            else:
+                packed.append(address)
+        return peerlist.encodePacked(packed) + (named,)
 
 class Torrent:
     """
     Class object to represent each torrent stored in the Tracker
     """
-    def __init__(self, tid, filename, numPieces):
+    __slots__ = ('tid', 'filename', 'pieces', 'content_hash', 'piece_hashes', 'manifest', 'aliases', 'seeders', 'leechers')
+
+    def __init__(self, tid, filename, numPieces, content_hash=None, piece_hashes=None, manifest=None):
         self.tid = tid
         self.filename = filename
         self.pieces = numPieces
-        self.seeders = dict()
-        self.leechers = dict()
+        self.content_hash = content_hash
+        self.piece_hashes = piece_hashes
+        self.manifest = manifest       # files of a directory torrent, None for a single file
+        self.aliases = [filename]      # every name the same content was uploaded under
+        self.seeders = PeerTable()
+        self.leechers = PeerTable()
     
     def addSeeder(self, pid: str, peer_ip, peer_port):
-        newSeeder = dict()
-        newSeeder[IP] = peer_ip
-        newSeeder[PORT] = peer_port
-        self.seeders[pid] = newSeeder
+        self.seeders.add(pid, peer_ip, peer_port)
 
     def removeSeeder(self, pid: str):
-        if pid in self.seeders:
-            del self.seeders[pid]
+        self.seeders.remove(pid)
 
     def addLeecher(self, pid: int, peer_ip, peer_port):
-        newLeecher = dict()
-        newLeecher[IP] = peer_ip
-        newLeecher[PORT] = peer_port
-        self.leechers[pid] = newLeecher
+        self.leechers.add(pid, peer_ip, peer_port)
 
     def removeLeecher(self, pid: str):
-        if pid in self.leechers:
-            del self.leechers[pid]
+        self.leechers.remove(pid)
+
+    def hasSeeder(self, pid: str) -> bool:
+        return pid in self.seeders
     
     def getSeeders(self) -> dict():
-        return self.seeders
+        return self.seeders.toDict()
 
     def getLeechers(self) -> dict():
-        return self.leechers
-        
\ No newline at end of file
+        return self.leechers.toDict()
@@ -0,0 +1,72 @@
+"""
+Transport tuning shared by the tracker and clients. Control traffic (tracker requests, peer exchange)
+is small request/response messages, so Nagle's algorithm is disabled on every connection. Piece
+transfers are bulk streams and additionally get larger kernel socket buffers.
+"""
+import asyncio
+import os
+import socket
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+TUNING_ENABLED = True
+LISTEN_BACKLOG = 1024                   # capped by the kernel's somaxconn
+DATA_BUFFER_SIZE = 4 * 1024 * 1024      # SO_SNDBUF / SO_RCVBUF for piece connections
+
+def installEventLoop() -> bool:
+    """
+    Installs uvloop as the event loop policy if P2PY_UVLOOP=1 and it is available. It is opt-in, as it
+    showed no gain on our transfer benchmark. Must be called before asyncio.run(). Returns True if uvloop is in use.
+    """
+    if uvloop is None or os.environ.get('P2PY_UVLOOP') != '1':
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+def tuneSocket(sock, data=False):
+    """
+    Sets TCP_NODELAY, and for data connections larger send/receive buffers.
+    Options the platform refuses are left at their defaults.
+    """
+    if not TUNING_ENABLED or sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if data:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, DATA_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, DATA_BUFFER_SIZE)
+    except OSError:
+        pass
+
+async def sendFile(writer, file, offset, count):
+    """
+    Sends count bytes of file from offset with loop.sendfile(), or with a plain read and write on event
+    loops that don't implement sendfile (uvloop).
+    """
+    try:
+        await asyncio.get_event_loop().sendfile(writer.transport, file, offset, count)
+    except NotImplementedError:
+        file.seek(offset)
+        writer.write(file.read(count))
+
+async def openConnection(ip, port, data=False):
+    """
+    asyncio.open_connection() with the socket tuned for control or data traffic.
+    """
+    reader, writer = await asyncio.open_connection(ip, int(port))
+    tuneSocket(writer.get_extra_info('socket'), data)
+    return reader, writer
+
+async def startServer(callback, ip, port, data=False):
+    """
+    asyncio.start_server() with a deeper listen backlog, tuning every accepted socket.
+    """
+    async def tunedCallback(reader, writer):
+        tuneSocket(writer.get_extra_info('socket'), data)
+        await callback(reader, writer)
+
+    backlog = LISTEN_BACKLOG if TUNING_ENABLED else 100
+    return await asyncio.start_server(tunedCallback, ip, port, backlog=backlog)